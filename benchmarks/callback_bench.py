@@ -0,0 +1,69 @@
+import argparse
+import datetime
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import callback_codec
+
+
+DT = datetime.datetime(2020, 10, 18, 12, 30)
+OLD_DT_FORMAT = '%Y.%m.%d.%H.%M'
+
+
+def old_route(data):
+    # Прежний разбор: split и цепочка if/elif со strptime в каждой ветке
+    calendar_data = data.split(':')
+    if calendar_data[0] == 'dt':
+        return datetime.datetime.strptime(calendar_data[1], OLD_DT_FORMAT)
+    elif calendar_data[0] == 'calendar':
+        return datetime.datetime.strptime(calendar_data[1], OLD_DT_FORMAT)
+    elif calendar_data[0] == 'calendar_day':
+        return datetime.datetime.strptime(calendar_data[1], OLD_DT_FORMAT)
+    elif calendar_data[0] == 'calendar_month':
+        return datetime.datetime.strptime(calendar_data[2], OLD_DT_FORMAT)
+    elif calendar_data[0] == 'today':
+        return datetime.datetime.strptime(calendar_data[1], OLD_DT_FORMAT)
+    elif calendar_data[0] == 'tomorrow':
+        return datetime.datetime.strptime(calendar_data[1], OLD_DT_FORMAT)
+    elif calendar_data[0] == 'edit':
+        return datetime.datetime.strptime(calendar_data[3], OLD_DT_FORMAT)
+    return None
+
+
+def new_route(data):
+    action, args = callback_codec.decode(data)
+    return ROUTES.get(action, lambda *args: None)(*args)
+
+
+ROUTES = {action: (lambda *args: args) for action in callback_codec.ACTIONS}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Callback data decoding: old text format vs compact codec')
+    parser.add_argument('--number', type=int, default=100000)
+    args = parser.parse_args()
+
+    old_data = f'edit:minute:next:{DT.strftime(OLD_DT_FORMAT)}'
+    new_data = callback_codec.encode('edit', 'minute', 'next', DT)
+    old_time = timeit.timeit(lambda: old_route(old_data), number=args.number)
+    new_time = timeit.timeit(lambda: new_route(new_data), number=args.number)
+    legacy_time = timeit.timeit(lambda: new_route(old_data), number=args.number)
+
+    print(json.dumps({
+        'benchmark': 'callback_decode',
+        'number': args.number,
+        'old_bytes': len(old_data.encode()),
+        'new_bytes': len(new_data.encode()),
+        'old_us': old_time / args.number * 1e6,
+        'new_us': new_time / args.number * 1e6,
+        'legacy_via_codec_us': legacy_time / args.number * 1e6,
+        'speedup': old_time / new_time
+    }))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+from collections import Counter
+from concurrent.futures import Future
+from threading import Lock
+import datetime
+import itertools
+import json
+import os
+import random
+import time
+import uuid
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+
+def setup_environment():
+    # Конфигурация бота для запуска без внешних сервисов
+    os.environ.setdefault('TELEGRAM_TOKEN', '123456:bench')
+    os.environ.setdefault('REDIS_URL', 'redis://localhost:6379/0')
+    os.environ.setdefault('GOOGLE_TOKEN', json.dumps({'installed': {
+        'client_id': 'bench', 'client_secret': 'bench',
+        'auth_uri': 'https://accounts.google.com/o/oauth2/auth', 'token_uri': 'https://oauth2.googleapis.com/token'}}))
+    # Лимиты квот не должны скрывать стоимость самой обработки; для проверки governor задаются явно
+    os.environ.setdefault('GOOGLE_GLOBAL_RATE', '1000000')
+    os.environ.setdefault('GOOGLE_USER_RATE', '1000000')
+    os.environ.setdefault('TELEGRAM_GLOBAL_RATE', '1000000')
+    os.environ.setdefault('TELEGRAM_CHAT_RATE', '1000000')
+
+
+def install_redis(redis_url=None):
+    # Подменяется пул соединений общего клиента: модули, получившие redis_db через from-import,
+    # работают с подменой и тогда, когда импортированы раньше вызова
+    import redis
+    import user_data
+    if redis_url is None:
+        import fakeredis
+        user_data.redis_db.connection_pool = fakeredis.FakeStrictRedis().connection_pool
+    else:
+        user_data.redis_db.connection_pool = redis.ConnectionPool.from_url(redis_url)
+    user_data.redis_db.flushdb()
+
+
+def make_http_error(status, reason=''):
+    content = json.dumps({'error': {'code': status, 'errors': [{'reason': reason}]}}).encode()
+    return HttpError(httplib2.Response({'status': status}), content)
+
+
+class CallCounter:
+    def __init__(self):
+        self._lock = Lock()
+        self.calls = Counter()
+
+    def record(self, method_id):
+        with self._lock:
+            self.calls[method_id] += 1
+
+    def total(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+
+
+class FakeRequest:
+    def __init__(self, service, method_id, func):
+        self.methodId = method_id
+        self.headers = {}
+        self._service = service
+        self._func = func
+
+    def run(self):
+        self._service.counter.record(self.methodId)
+        self._service.maybe_fail()
+        return self._func(self.headers)
+
+    def execute(self):
+        self._service.wait()
+        return self.run()
+
+
+class FakeBatch:
+    methodId = 'batch'
+
+    def __init__(self, service, callback):
+        self._service = service
+        self._callback = callback
+        self._requests = []
+
+    def __len__(self):
+        return len(self._requests)
+
+    def add(self, request, request_id=None, callback=None):
+        self._requests.append((request_id or str(len(self._requests)), request, callback or self._callback))
+
+    def execute(self):
+        # Один сетевой запрос на весь batch, каждый вложенный запрос учитывается в квоте
+        self._service.wait()
+        for request_id, request, callback in self._requests:
+            try:
+                response, exception = request.run(), None
+            except HttpError as e:
+                response, exception = None, e
+            callback(request_id, response, exception)
+
+
+class FakeCalendar:
+    def __init__(self, calendar_id, summary):
+        self.id = calendar_id
+        self.summary = summary
+        self.events = {}
+        # Журнал изменений (версия, событие) для syncToken
+        self.log = []
+
+
+class FakeResource:
+    def __init__(self, service, prefix):
+        self._service = service
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        func = getattr(self._service, f'_{self._prefix}_{name}')
+
+        def method(**params):
+            return FakeRequest(self._service, f'calendar.{self._prefix}.{name}',
+                               lambda headers: func(headers=headers, **params))
+        return method
+
+
+class FakeCalendarService:
+    # Подмножество googleapiclient Calendar v3, используемое ботом, с задержкой и внедрением ошибок
+    def __init__(self, counter=None, calendars=3, events_per_calendar=20, latency=0.0, error_rate=0.0,
+                 tz_name='UTC', page_size=100):
+        self.counter = counter or CallCounter()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.page_size = page_size
+        self.tz_name = tz_name
+        self._lock = Lock()
+        self._version = itertools.count(1)
+        self._calendars = {}
+        self._calendars_version = 1
+        now = datetime.datetime.now(datetime.timezone.utc).replace(second=0, microsecond=0)
+        for i in range(calendars):
+            calendar = self._add_calendar(uuid.uuid4().hex, f'calendar {i}')
+            for j in range(events_per_calendar):
+                start = now + datetime.timedelta(minutes=random.randint(-7 * 24 * 60, 7 * 24 * 60))
+                self._put_event(calendar, {
+                    'id': uuid.uuid4().hex,
+                    'status': 'confirmed',
+                    'summary': f'event {j}',
+                    'start': {'dateTime': start.isoformat()},
+                    'end': {'dateTime': (start + datetime.timedelta(hours=1)).isoformat()}
+                })
+        self._primary_id = next(iter(self._calendars))
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def maybe_fail(self):
+        if self.error_rate and random.random() < self.error_rate:
+            raise make_http_error(503, 'backendError')
+
+    def calendarList(self):
+        return FakeResource(self, 'calendarList')
+
+    def calendars(self):
+        return FakeResource(self, 'calendars')
+
+    def events(self):
+        return FakeResource(self, 'events')
+
+    def channels(self):
+        return FakeResource(self, 'channels')
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    def _add_calendar(self, calendar_id, summary):
+        calendar = FakeCalendar(calendar_id, summary)
+        self._calendars[calendar_id] = calendar
+        self._calendars_version += 1
+        return calendar
+
+    def _get_calendar(self, calendar_id):
+        if calendar_id == 'primary':
+            calendar_id = self._primary_id
+        calendar = self._calendars.get(calendar_id)
+        if calendar is None:
+            raise make_http_error(404, 'notFound')
+        return calendar
+
+    def _put_event(self, calendar, event):
+        calendar.events[event['id']] = event
+        calendar.log.append((next(self._version), event))
+
+    def _calendarList_list(self, headers, pageToken=None, **params):
+        with self._lock:
+            etag = f'"{self._calendars_version}"'
+            if pageToken is None and headers.get('If-None-Match') == etag:
+                raise make_http_error(304)
+            items = [{'id': calendar.id, 'summary': calendar.summary, 'timeZone': self.tz_name}
+                     for calendar in self._calendars.values()]
+            offset = int(pageToken or 0)
+            response = {'etag': etag, 'items': items[offset:offset + self.page_size]}
+            if offset + self.page_size < len(items):
+                response['nextPageToken'] = str(offset + self.page_size)
+            return response
+
+    def _calendarList_insert(self, headers, body):
+        with self._lock:
+            self._get_calendar(body['id'])
+            raise make_http_error(409, 'duplicate')
+
+    def _calendars_get(self, headers, calendarId):
+        with self._lock:
+            calendar = self._get_calendar(calendarId)
+            return {'id': calendar.id, 'summary': calendar.summary, 'timeZone': self.tz_name}
+
+    def _calendars_insert(self, headers, body):
+        with self._lock:
+            calendar = self._add_calendar(uuid.uuid4().hex, body['summary'])
+            return {'id': calendar.id, 'summary': calendar.summary, 'timeZone': self.tz_name}
+
+    def _events_list(self, headers, calendarId, syncToken=None, pageToken=None, maxResults=250, **params):
+        with self._lock:
+            calendar = self._get_calendar(calendarId)
+            if syncToken is not None:
+                items = [event for version, event in calendar.log if version > int(syncToken)]
+            else:
+                items = [event for event in calendar.events.values() if event['status'] != 'cancelled']
+            offset = int(pageToken or 0)
+            page_size = min(maxResults, self.page_size)
+            response = {'items': items[offset:offset + page_size]}
+            if offset + page_size < len(items):
+                response['nextPageToken'] = str(offset + page_size)
+            else:
+                response['nextSyncToken'] = str(calendar.log[-1][0] if calendar.log else 0)
+            return response
+
+    def _events_get(self, headers, calendarId, eventId):
+        with self._lock:
+            event = self._get_calendar(calendarId).events.get(eventId)
+            if event is None or event['status'] == 'cancelled':
+                raise make_http_error(404, 'notFound')
+            return event
+
+    def _events_insert(self, headers, calendarId, body):
+        with self._lock:
+            calendar = self._get_calendar(calendarId)
+            # id, заданный клиентом, не может повторяться и после удаления события
+            if body.get('id') in calendar.events:
+                raise make_http_error(409, 'duplicate')
+            event = dict(body, status='confirmed')
+            event.setdefault('id', uuid.uuid4().hex)
+            self._put_event(calendar, event)
+            return event
+
+    def _events_delete(self, headers, calendarId, eventId):
+        with self._lock:
+            calendar = self._get_calendar(calendarId)
+            if eventId not in calendar.events:
+                raise make_http_error(404, 'notFound')
+            self._put_event(calendar, {'id': eventId, 'status': 'cancelled'})
+            return ''
+
+    def _events_watch(self, headers, calendarId, body):
+        with self._lock:
+            self._get_calendar(calendarId)
+            return {'id': body['id'], 'resourceId': uuid.uuid4().hex,
+                    'expiration': str(int((time.time() + 7 * 24 * 60 * 60) * 1000))}
+
+    def _channels_stop(self, headers, body):
+        return ''
+
+
+class FakeTelegramApi:
+    # Замена telebot.apihelper._make_request: запросы к Telegram не покидают процесс
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.counter = CallCounter()
+        self._message_ids = itertools.count(1)
+
+    def install(self):
+        import telebot.apihelper
+        telebot.apihelper._make_request = self._make_request
+
+    def _make_request(self, token, method_name, method='get', params=None, files=None):
+        self.counter.record(method_name)
+        if self.latency:
+            time.sleep(self.latency)
+        params = params or {}
+        if method_name == 'getUpdates':
+            return []
+        if 'chat_id' not in params:
+            return True
+        return {
+            'message_id': int(params.get('message_id') or next(self._message_ids)),
+            'date': int(time.time()),
+            'chat': {'id': int(params['chat_id']), 'type': 'private'},
+            'text': params.get('text', '')
+        }
+
+
+class FakeSender:
+    # Отправитель напоминаний, сразу завершающий Future
+    def __init__(self):
+        self.sent = 0
+
+    def send_message(self, *args, **kwargs):
+        self.sent += 1
+        future = Future()
+        future.set_result(None)
+        return future
+
+
+class AllShards:
+    def owns(self, user_id):
+        return True
+
+
+def message_update(update_id, user_id, text):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}] if text.startswith('/') else []
+        }
+    }
+
+
+def callback_update(update_id, user_id, data, message_id=1):
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench'},
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'text': ''
+            }
+        }
+    }
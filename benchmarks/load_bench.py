@@ -0,0 +1,150 @@
+import argparse
+import datetime
+import itertools
+import json
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import callback_codec
+from fakes import (AllShards, CallCounter, FakeCalendarService, FakeSender, FakeTelegramApi,
+                   callback_update, install_redis, message_update, setup_environment)
+
+
+def percentiles(values):
+    if len(values) < 2:
+        values = values * 2 or [0, 0]
+    quantiles = statistics.quantiles(values, n=100)
+    return {'p50': quantiles[49] * 1000, 'p95': quantiles[94] * 1000, 'p99': quantiles[98] * 1000}
+
+
+def create_users(registry, user_ids, counter, args):
+    for user_id in user_ids:
+        user = registry.get(user_id)
+        user.service = FakeCalendarService(counter, calendars=args.calendars, events_per_calendar=args.events,
+                                           latency=args.google_latency, error_rate=args.error_rate)
+
+
+def run_session(bot, telebot, user_id, update_ids, latencies):
+    # Диалоги /tasks -> выбор дня и /add -> имя -> выбор времени
+    now = datetime.datetime.utcnow().replace(second=0, microsecond=0)
+    steps = [
+        ('tasks_command', message_update(next(update_ids), user_id, '/tasks')),
+        ('tasks_day', callback_update(next(update_ids), user_id, callback_codec.encode('calendar_day', now, True))),
+        ('add_command', message_update(next(update_ids), user_id, '/add')),
+        ('add_name', message_update(next(update_ids), user_id, 'bench task')),
+        ('add_dt', callback_update(next(update_ids), user_id, callback_codec.encode('dt', now))),
+    ]
+    for name, update_json in steps:
+        update = telebot.types.Update.de_json(update_json)
+        start = time.perf_counter()
+        bot.process_update(update)
+        latencies[name].append(time.perf_counter() - start)
+
+
+def bench_handlers(bot, telebot, counter, args):
+    user_ids = list(range(1, args.handler_users + 1))
+    create_users(bot.users, user_ids, counter, args)
+    update_ids = itertools.count(1)
+    latencies = {name: [] for name in ('tasks_command', 'tasks_day', 'add_command', 'add_name', 'add_dt')}
+
+    counter.reset()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        # Сессии одного пользователя идут последовательно, как в UpdateDispatcher
+        jobs = [executor.submit(lambda user_id: [run_session(bot, telebot, user_id, update_ids, latencies)
+                                                 for _ in range(args.sessions)], user_id)
+                for user_id in user_ids]
+        for job in jobs:
+            job.result()
+    elapsed = time.perf_counter() - start
+
+    return {
+        'users': len(user_ids),
+        'sessions': len(user_ids) * args.sessions,
+        'updates_per_sec': sum(len(values) for values in latencies.values()) / elapsed,
+        'latency_ms': {name: percentiles(values) for name, values in latencies.items()},
+        'google_calls_per_min': counter.total() / elapsed * 60,
+        'google_calls': dict(counter.calls)
+    }
+
+
+def refresh_pass(sender):
+    start = time.perf_counter()
+    sender.refresh_now()
+    return time.perf_counter() - start
+
+
+def bench_notifier(scale, counter, args):
+    from notify_sender import NotifySender
+    from user_registry import UserRegistry
+
+    registry = UserRegistry()
+    create_users(registry, range(10 ** 9, 10 ** 9 + scale), counter, args)
+    sender = NotifySender(FakeSender(), registry, AllShards())
+
+    counter.reset()
+    cold = refresh_pass(sender)
+    cold_calls = counter.total()
+    # Повторный проход: кэш календарей и инкрементальная синхронизация по syncToken
+    for user_id in registry.user_ids():
+        registry.peek(user_id).events.invalidate()
+    counter.reset()
+    warm = refresh_pass(sender)
+
+    return {
+        'users': scale,
+        'cold_pass_sec': cold,
+        'cold_google_calls': cold_calls,
+        'warm_pass_sec': warm,
+        'warm_google_calls': counter.total(),
+        'google_calls_per_min': (cold_calls + counter.total()) / (cold + warm) * 60,
+        'queued_reminders': sender.pending_reminders()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Handler and reminder load test against fake Telegram and Google')
+    parser.add_argument('--redis-url', default=None, help='real Redis instead of fakeredis (the database is flushed)')
+    parser.add_argument('--handler-users', type=int, default=100)
+    parser.add_argument('--sessions', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--notifier-users', default='100,1000,10000')
+    parser.add_argument('--calendars', type=int, default=3)
+    parser.add_argument('--events', type=int, default=20, help='events per calendar')
+    parser.add_argument('--google-latency', type=float, default=0.0, help='seconds per Google request')
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help='seconds per Telegram request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of Google requests failing with 503')
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    setup_environment()
+    install_redis(args.redis_url)
+    telegram = FakeTelegramApi(args.telegram_latency)
+    telegram.install()
+
+    import telebot
+    import bot
+
+    bot.send_queue.start()
+    counter = CallCounter()
+    result = {
+        'benchmark': 'load',
+        'handlers': bench_handlers(bot, telebot, counter, args),
+        'notifier': [bench_notifier(int(scale), counter, args) for scale in args.notifier_users.split(',')],
+        'telegram_calls': dict(telegram.counter.calls)
+    }
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
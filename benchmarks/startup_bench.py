@@ -0,0 +1,90 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from fakes import setup_environment
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Модули, которые не должны загружаться до первого обращения к Google
+LAZY_MODULES = ['googleapiclient.discovery', 'google_auth_oauthlib', 'oauthlib', 'google.oauth2.credentials',
+                'google.auth.transport.requests']
+
+# Запуск бота в отдельном процессе: импорт, запуск фоновых потоков и первый getUpdates.
+# Окружение задает родительский процесс, подмены Redis и Telegram устанавливаются после замеренного импорта:
+# иначе fakes загружает redis, telebot и googleapiclient до начала замера. Импорт бота к ним не обращается.
+CHILD = '''
+import json, os, sys, threading, time
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+start = time.perf_counter()
+import bot
+import_seconds = time.perf_counter() - start
+lazy_loaded = [name for name in json.loads(sys.argv[2]) if name in sys.modules]
+import startup
+setup_start = time.perf_counter()
+from fakes import FakeTelegramApi, install_redis
+install_redis(sys.argv[1] or None)
+FakeTelegramApi().install()
+# Время установки подмен не входит в следующие этапы запуска
+startup.STARTED += time.perf_counter() - setup_start
+threading.Thread(target=bot.main, daemon=True).start()
+deadline = time.perf_counter() + 30
+while 'first_get_updates' not in startup.get_stages() and time.perf_counter() < deadline:
+    time.sleep(0.001)
+print(json.dumps({'import_bot_sec': import_seconds, 'lazy_modules_loaded': lazy_loaded,
+                  'stages_sec': startup.get_stages()}))
+sys.stdout.flush()
+os._exit(0)
+'''
+
+
+def parse_import_times(stderr):
+    # Строки -X importtime: "import time: self [us] | cumulative | имя", вложенность - отступ имени
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        top = name.split('.')[0]
+        if name == top:
+            times[top] = max(times.get(top, 0), int(cumulative) / 1e6)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bot cold start: import time per module and time to first getUpdates')
+    parser.add_argument('--redis-url', default='', help='real Redis instead of fakeredis (the database is flushed)')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--top', type=int, default=15, help='number of slowest modules in the report')
+    args = parser.parse_args()
+
+    setup_environment()
+    env = dict(os.environ, METRICS_PORT='0')
+    runs = []
+    for _ in range(args.runs):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', CHILD, args.redis_url,
+                                  json.dumps(LAZY_MODULES)],
+                                 cwd=BENCH_DIR, env=env, capture_output=True, text=True, check=True)
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        result['import_times'] = parse_import_times(process.stderr)
+        runs.append(result)
+
+    # Лучший запуск меньше всего зависит от кэша файловой системы и загрузки машины
+    best = min(runs, key=lambda run: run['stages_sec'].get('first_get_updates', float('inf')))
+    slowest = sorted(best['import_times'].items(), key=lambda item: item[1], reverse=True)[:args.top]
+    print(json.dumps({
+        'benchmark': 'startup',
+        'runs': args.runs,
+        'import_bot_sec': best['import_bot_sec'],
+        'stages_sec': best['stages_sec'],
+        'lazy_modules_loaded': best['lazy_modules_loaded'],
+        'slowest_imports_sec': dict(slowest)
+    }))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fakes import AllShards, CallCounter, FakeCalendarService, install_redis, setup_environment
+
+
+TOKEN = 'bench-token'
+PATH = '/calendar'
+
+
+def send_notification(port, channel_id, state='exists', token=TOKEN):
+    # Имитация Google: POST без тела, данные канала в заголовках
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    start = time.perf_counter()
+    connection.request('POST', PATH, b'', {'X-Goog-Channel-ID': channel_id,
+                                           'X-Goog-Channel-Token': token,
+                                           'X-Goog-Resource-ID': 'bench',
+                                           'X-Goog-Resource-State': state,
+                                           'Content-Length': '0'})
+    status = connection.getresponse().status
+    elapsed = time.perf_counter() - start
+    connection.close()
+    return status, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calendar push channel receiver with a local stand-in for Google')
+    parser.add_argument('--redis-url', default=None, help='real Redis instead of fakeredis (the database is flushed)')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--calendars', type=int, default=3)
+    parser.add_argument('--notifications', type=int, default=5000)
+    parser.add_argument('--senders', type=int, default=16)
+    args = parser.parse_args()
+
+    setup_environment()
+    os.environ['WATCH_TOKEN'] = TOKEN
+    install_redis(args.redis_url)
+    import user_data
+    import watch
+    from user_registry import UserRegistry
+    from webhook import WebhookServer
+
+    counter = CallCounter()
+    registry = UserRegistry()
+    for user_id in range(1, args.users + 1):
+        registry.get(user_id).service = FakeCalendarService(counter, calendars=args.calendars, events_per_calendar=0)
+
+    # Открытие каналов для всех календарей и их продление
+    watcher = watch.CalendarWatcher(registry, AllShards())
+    start = time.perf_counter()
+    watcher.check_users()
+    check_time = time.perf_counter() - start
+    channels = {channel_id.decode(): watch.get_channel_user_id(channel_id.decode())
+                for channel_id in user_data.redis_db.zrange(watch.CHANNELS_KEY, 0, -1)}
+    user_data.redis_db.zadd(watch.CHANNELS_KEY, {channel_id: time.time() for channel_id in channels})
+    counter.reset()
+    start = time.perf_counter()
+    watcher.renew_channels()
+    renew_time = time.perf_counter() - start
+    renew_calls = dict(counter.calls)
+    channels = {channel_id.decode(): watch.get_channel_user_id(channel_id.decode())
+                for channel_id in user_data.redis_db.zrange(watch.CHANNELS_KEY, 0, -1)}
+
+    invalidated = []
+    server = WebhookServer(('127.0.0.1', 0))
+    server.add_route(PATH, watch.watch_route(watch.WATCH_TOKEN, invalidated.append))
+    server.start()
+    port = server.server_address[1]
+
+    channel_ids = list(channels)
+    sent = [random.choice(channel_ids) for _ in range(args.notifications)]
+    expected = Counter(channels[channel_id] for channel_id in sent)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.senders) as executor:
+        results = list(executor.map(lambda channel_id: send_notification(port, channel_id), sent))
+        sync_results = list(executor.map(lambda channel_id: send_notification(port, channel_id, 'sync'),
+                                         channel_ids[:100]))
+        forged = list(executor.map(lambda channel_id: send_notification(port, channel_id, token='forged'),
+                                   channel_ids[:100]))
+    total = time.perf_counter() - start
+    server.shutdown()
+
+    latencies = sorted(elapsed for _, elapsed in results)
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(json.dumps({
+        'benchmark': 'watch_channels',
+        'channels': len(channels),
+        'check_sec': check_time,
+        'renew_sec': renew_time,
+        'renew_google_calls': renew_calls,
+        'notifications': args.notifications,
+        'notifications_per_sec': args.notifications / total,
+        'accepted': sum(1 for status, _ in results if status == 200),
+        'sync_ignored': all(status == 200 for status, _ in sync_results),
+        'forged_rejected': all(status == 403 for status, _ in forged),
+        'invalidations_match': Counter(invalidated) == expected,
+        'ack_ms': {'p50': quantiles[49] * 1000, 'p95': quantiles[94] * 1000, 'p99': quantiles[98] * 1000}
+    }))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import http.client
+import json
+import os
+import queue
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from webhook import WebhookServer, telegram_route
+
+
+SECRET = 'bench-secret'
+PATH = '/telegram'
+
+
+def make_update(update_id):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': update_id % 1000, 'type': 'private'},
+            'from': {'id': update_id % 1000, 'is_bot': False, 'first_name': 'bench'},
+            'text': '/tasks'
+        }
+    }
+
+
+def send_update(port, update_id):
+    # Имитация Telegram: POST обновления с секретным токеном
+    body = json.dumps(make_update(update_id))
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    start = time.perf_counter()
+    connection.request('POST', PATH, body, {'Content-Type': 'application/json',
+                                            'X-Telegram-Bot-Api-Secret-Token': SECRET})
+    status = connection.getresponse().status
+    elapsed = time.perf_counter() - start
+    connection.close()
+    return status, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Webhook ingestion latency with a local fake Telegram sender')
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--senders', type=int, default=16)
+    args = parser.parse_args()
+
+    updates = queue.Queue()
+    server = WebhookServer(('127.0.0.1', 0))
+    server.add_route(PATH, telegram_route(SECRET, lambda update: updates.put(update) or True))
+    server.start()
+    port = server.server_address[1]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.senders) as executor:
+        results = list(executor.map(lambda update_id: send_update(port, update_id), range(args.updates)))
+    total = time.perf_counter() - start
+    server.shutdown()
+
+    latencies = sorted(elapsed for _, elapsed in results)
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(json.dumps({
+        'benchmark': 'webhook_ingestion',
+        'updates': args.updates,
+        'senders': args.senders,
+        'accepted': sum(1 for status, _ in results if status == 200),
+        'queued': updates.qsize(),
+        'updates_per_sec': args.updates / total,
+        'ack_ms': {'p50': quantiles[49] * 1000, 'p95': quantiles[94] * 1000, 'p99': quantiles[98] * 1000}
+    }))
+
+
+if __name__ == '__main__':
+    main()
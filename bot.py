@@ -1,55 +1,158 @@
+# Первым импортом: от него отсчитывается время запуска
+import startup
 import random
 import datetime
+import io
 import os
+import time
+from dateutil.relativedelta import relativedelta
 from dateutil.tz import gettz
 
 import telebot
 
+import callback_codec
 import keyboard
+import metrics
 import taskutils
 import states
+import task_export
+import task_import
+import watch
+from dispatcher import UpdateDispatcher
 from notify_sender import NotifySender
-from user_data import UserData, AUTHORIZATION_URL
+from send_queue import SendQueue, INTERACTIVE, REMINDER
+from sharding import ShardLeases
+from user_data import get_authorization_url, redis_db, token_refresher
+from user_registry import UserRegistry
+from webhook import WebhookServer, telegram_route
+
+startup.mark('imports')
 
 TELEGRAM_TOKEN = os.environ['TELEGRAM_TOKEN']
-bot = telebot.TeleBot(TELEGRAM_TOKEN)
+# Количество потоков обработки обновлений и максимальный размер очереди обновлений
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', 8))
+UPDATE_BACKLOG = int(os.environ.get('UPDATE_BACKLOG', 1000))
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+PORT = int(os.environ.get('PORT', 8443))
+# Максимальный размер импортируемого файла (байт)
+IMPORT_MAX_SIZE = int(os.environ.get('IMPORT_MAX_SIZE', 1024 * 1024))
+# Адрес HTTP-сервера метрик Prometheus, порт 0 - сервер не запускается
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9100))
+
+# Команды, которые используются как значение метки в метриках
+COMMANDS = {'start', 'help', 'auth', 'add', 'delete', 'tasks', 'week', 'month', 'import', 'export'}
+STATE_NAMES = {value: name[:-len('_STATE')].lower() for name, value in vars(states).items() if name.endswith('_STATE')}
+
+HANDLER_SECONDS = metrics.Histogram('update_handler_seconds', 'Update processing time', ['state', 'command'])
+REDIS_ROUND_TRIPS = metrics.Histogram('update_redis_round_trips', 'Redis round trips per update',
+                                      buckets=(0, 1, 2, 3, 5, 8, 13, 21))
+
+
+class DispatchingTeleBot(telebot.TeleBot):
+    def process_new_updates(self, updates):
+        # Смещение getUpdates сдвигается до постановки в очередь: иначе следующий запрос вернет обновления,
+        # которые еще обрабатываются. Смещение меняет только поток получения обновлений - в обработчиках
+        # TeleBot.process_new_updates не меняет его, так как номер обновления уже не больше смещения.
+        for update in updates:
+            self.last_update_id = max(self.last_update_id, update.update_id)
+            update_dispatcher.submit(update)
 
+    def get_updates(self, *args, **kwargs):
+        updates = telebot.TeleBot.get_updates(self, *args, **kwargs)
+        startup.mark('first_get_updates')
+        return updates
 
-data = {}
+
+bot = DispatchingTeleBot(TELEGRAM_TOKEN, threaded=False)
+send_queue = SendQueue(bot)
+replies = send_queue.client(INTERACTIVE)
+
+
+users = UserRegistry()
 
 
 def get_user_data(user_id):
-    if user_id not in data:
-        user = UserData(user_id)
-        data[user_id] = user
-        return user
-    else:
-        return data[user_id]
+    return users.get(user_id)
+
+
+def get_update_user_id(update):
+    for item in (update.message, update.edited_message, update.callback_query):
+        if item is not None:
+            return item.from_user.id
+    return update.update_id
+
+
+def get_update_command(update):
+    if update.callback_query is not None:
+        action, _ = callback_codec.decode(update.callback_query.data)
+        return f'callback_{action}' if action else 'callback'
+    message = update.message or update.edited_message
+    command = telebot.util.extract_command(message.text) if message is not None and message.text else None
+    if command is None:
+        return 'text'
+    return command if command in COMMANDS else 'unknown'
+
+
+def process_update(update):
+    user_id = get_update_user_id(update)
+    user = users.peek(user_id)
+    # Пользователь, еще не загруженный из Redis, помечается как new
+    state = STATE_NAMES.get(user.state, 'unknown') if user is not None else 'new'
+    metrics.pop_redis_round_trips()
+    start = time.perf_counter()
+    try:
+        telebot.TeleBot.process_new_updates(bot, [update])
+    finally:
+        # Изменения состояния пользователя записываются в Redis один раз после обработки обновления
+        user = users.peek(user_id)
+        if user is not None:
+            user.flush()
+        HANDLER_SECONDS.labels(state, get_update_command(update)).observe(time.perf_counter() - start)
+        REDIS_ROUND_TRIPS.observe(metrics.pop_redis_round_trips())
+
+
+def submit_update_json(update_json):
+    return update_dispatcher.try_submit(telebot.types.Update.de_json(update_json))
+
+
+update_dispatcher = UpdateDispatcher(process_update, get_update_user_id, UPDATE_WORKERS, UPDATE_BACKLOG)
+
+metrics.Gauge('update_queue_depth', 'Updates waiting for processing', update_dispatcher.depth)
+metrics.Gauge('send_queue_depth', 'Outgoing Telegram calls waiting for sending', send_queue.depth)
 
 
 @bot.message_handler(commands=['start', 'help'])
 def start_handler(message):
     user = get_user_data(message.from_user.id)
     auth_message = '\n\n*Вы не авторизованы в Google аккаунте.*' if not user.service else ''
-    bot.send_message(user.user_id,
-                     'Вас приветствует календарь бот, работающий с Google Календарем. '
-                     'Вы можете создавать, удалять, просматривать задачи и получать уведомления.\n\n'
-                     'Для отображения времени задач, используется временная зона Вашего главного календаря\n\n'
-                     'Команда /auth - авторизация в Google Календаре\n'
-                     'Команда /add - добавление задачу\n'
-                     'Команда /delete - удаление задачу\n'
-                     'Команда /tasks - список задач\n'
-                     'Команда /help - данная справка{0}'.format(auth_message),
-                     parse_mode='MARKDOWN')
+    replies.send_message(user.user_id,
+                         'Вас приветствует календарь бот, работающий с Google Календарем. '
+                         'Вы можете создавать, удалять, просматривать задачи и получать уведомления.\n\n'
+                         'Для отображения времени задач, используется временная зона Вашего главного календаря\n\n'
+                         'Команда /auth - авторизация в Google Календаре\n'
+                         'Команда /add - добавление задачу\n'
+                         'Команда /delete - удаление задачу\n'
+                         'Команда /tasks - список задач\n'
+                         'Команда /week - задачи на неделю\n'
+                         'Команда /month - задачи на месяц\n'
+                         'Команда /import - импорт списка задач или файла .ics\n'
+                         'Команда /export [дд.мм.гггг дд.мм.гггг] - выгрузка задач в файл .ics\n'
+                         'Команда /help - данная справка{0}'.format(auth_message),
+                         parse_mode='MARKDOWN')
     user.state = states.MAIN_STATE
 
 
 def no_auth_handler(message):
     user = get_user_data(message.from_user.id)
-    bot.send_message(message.from_user.id,
-                     '*Вы не авторизованы в Google аккаунте.*\n'
-                     'Авторизация: /auth',
-                     parse_mode='MARKDOWN')
+    replies.send_message(message.from_user.id,
+                         '*Вы не авторизованы в Google аккаунте.*\n'
+                         'Авторизация: /auth',
+                         parse_mode='MARKDOWN')
     user.state = states.MAIN_STATE
 
 
@@ -57,17 +160,17 @@ def no_auth_handler(message):
 def auth_handler(message):
     user = get_user_data(message.from_user.id)
     if not user.service:
-        bot.send_message(user.user_id,
-                         'Для авторизации в Google аккаунте и '
-                         'предоставления доступа боту к Вашему календарю пройдите по [ссылке]({0}).\n\n'
-                         'После авторизации отправьте боту полученный код.'.format(AUTHORIZATION_URL),
-                         parse_mode="MARKDOWN")
+        replies.send_message(user.user_id,
+                             'Для авторизации в Google аккаунте и '
+                             'предоставления доступа боту к Вашему календарю пройдите по [ссылке]({0}).\n\n'
+                             'После авторизации отправьте боту полученный код.'.format(get_authorization_url()),
+                             parse_mode="MARKDOWN")
     else:
-        bot.send_message(user.user_id,
-                         '*Вы уже авторизированы в Google аккаунте.*\n\n'
-                         'Для смены пользователя пройдите по [ссылке]({0}).\n\n'
-                         'После авторизации отправьте боту полученный код.'.format(AUTHORIZATION_URL),
-                         parse_mode="MARKDOWN")
+        replies.send_message(user.user_id,
+                             '*Вы уже авторизированы в Google аккаунте.*\n\n'
+                             'Для смены пользователя пройдите по [ссылке]({0}).\n\n'
+                             'После авторизации отправьте боту полученный код.'.format(get_authorization_url()),
+                             parse_mode="MARKDOWN")
     user.state = states.AUTHORIZATION_STATE
 
 
@@ -76,11 +179,12 @@ def authorization_handler(message):
 
     code = message.text
     if not user.init_service(code):
-        bot.reply_to(message, 'Неверный код авторизации!!!\n'
-                              'Введите код, скопированный из авторизационной формы Google.')
+        replies.reply_to(message, 'Неверный код авторизации!!!\n'
+                                  'Введите код, скопированный из авторизационной формы Google.')
     else:
-        bot.reply_to(message, 'Авторизация прошла успешно. '
-                              'Теперь Вы можете взаимодействовать со своим Google Календарем.')
+        replies.reply_to(message, 'Авторизация прошла успешно. '
+                                  'Теперь Вы можете взаимодействовать со своим Google Календарем.')
+        sender.invalidate(user.user_id)
         user.state = states.MAIN_STATE
 
 
@@ -90,7 +194,7 @@ def add_handler(message):
     if not user.service:
         no_auth_handler(message)
         return
-    bot.send_message(user.user_id, 'Добавление задачи. Введите имя.')
+    replies.send_message(user.user_id, 'Добавление задачи. Введите имя.')
     user.state = states.ENTER_ADDED_TASK_NAME_STATE
 
 
@@ -99,7 +203,7 @@ def enter_added_task_name_handler(message):
     user.current_task_name = message.text
     now = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
     markup = keyboard.create_date_time_widget(now.astimezone(gettz(user.tz_name)))
-    bot.send_message(message.from_user.id, 'Введите дату и время начала задачи.', reply_markup=markup)
+    replies.send_message(message.from_user.id, 'Введите дату и время начала задачи.', reply_markup=markup)
     user.state = states.ENTER_ADDED_TASK_DATE_STATE
 
 
@@ -111,7 +215,8 @@ def delete_handler(message):
         return
     now = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
     markup = keyboard.create_calendar(now.astimezone(gettz(user.tz_name)), True)
-    bot.send_message(user.user_id, 'Укажите дату:', reply_markup=markup)
+    replies.send_message(user.user_id, 'Укажите дату:', reply_markup=markup)
+    user.prefetch_tasks()
     user.state = states.DELETE_TASK_STATE
 
 
@@ -124,10 +229,114 @@ def tasks_handler(message):
 
     now = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
     markup = keyboard.create_calendar(now.astimezone(gettz(user.tz_name)), True)
-    bot.send_message(user.user_id, 'Укажите дату:', reply_markup=markup)
+    replies.send_message(user.user_id, 'Укажите дату:', reply_markup=markup)
+    user.prefetch_tasks()
     user.state = states.TASKS_STATE
 
 
+@bot.message_handler(commands=['week', 'month'])
+def agenda_handler(message):
+    user = get_user_data(message.from_user.id)
+    if not user.service:
+        no_auth_handler(message)
+        return
+
+    # Задачи всего периода загружаются одним запросом и группируются по дням
+    today = datetime.datetime.now(gettz(user.tz_name)).date()
+    if telebot.util.extract_command(message.text) == 'week':
+        max_date = today + datetime.timedelta(days=7)
+    else:
+        max_date = today + relativedelta(months=1)
+    tasks = user.get_period_tasks(today, max_date)
+    for text in taskutils.split_message(taskutils.agenda_to_string(tasks, user.tz_name, today)):
+        replies.send_message(user.user_id, text, parse_mode='MARKDOWN')
+    user.state = states.MAIN_STATE
+
+
+@bot.message_handler(commands=['export'])
+def export_handler(message):
+    user = get_user_data(message.from_user.id)
+    if not user.service:
+        no_auth_handler(message)
+        return
+
+    # Период задается датами начала и окончания включительно, по умолчанию - месяц с сегодняшнего дня
+    dates = (telebot.util.extract_arguments(message.text) or '').split()
+    today = datetime.datetime.now(gettz(user.tz_name)).date()
+    try:
+        if not dates:
+            min_date, max_date = today, today + relativedelta(months=1)
+        elif len(dates) == 2:
+            min_date, max_date = (datetime.datetime.strptime(date, '%d.%m.%Y').date() for date in dates)
+            max_date += datetime.timedelta(days=1)
+        else:
+            raise ValueError(dates)
+    except ValueError:
+        replies.send_message(user.user_id, 'Укажите период в формате /export дд.мм.гггг дд.мм.гггг')
+        return
+    if max_date <= min_date:
+        replies.send_message(user.user_id, 'Дата окончания раньше даты начала.')
+        return
+
+    document = task_export.make_ics_file(task_export.get_file_name(min_date, max_date - datetime.timedelta(days=1)),
+                                         user.iter_period_tasks(min_date, max_date), user.tz_name)
+    replies.send_document(user.user_id, document)
+    user.state = states.MAIN_STATE
+
+
+@bot.message_handler(commands=['import'])
+def import_handler(message):
+    user = get_user_data(message.from_user.id)
+    if not user.service:
+        no_auth_handler(message)
+        return
+
+    # Список задач может быть отправлен в одном сообщении с командой
+    text = message.text.partition('\n')[2]
+    if text.strip():
+        import_text_handler(message, text)
+        return
+    replies.send_message(user.user_id, 'Импорт задач. Отправьте список задач, по одной в строке, '
+                                       'в формате "дд.мм ЧЧ:ММ название" или файл .ics.')
+    user.state = states.IMPORT_STATE
+
+
+def import_text_handler(message, text):
+    user = get_user_data(message.from_user.id)
+    today = datetime.datetime.now(gettz(user.tz_name)).date()
+    send_import_report(user, task_import.parse_text(text.splitlines(), user.tz_name, today))
+
+
+@bot.message_handler(content_types=['document'])
+def document_handler(message):
+    user = get_user_data(message.from_user.id)
+    if user.state != states.IMPORT_STATE or not user.service:
+        replies.send_message(user.user_id, 'Не понял, повтори...')
+        return
+
+    document = message.document
+    if document.file_size and document.file_size > IMPORT_MAX_SIZE:
+        replies.send_message(user.user_id, 'Файл слишком большой.')
+        return
+    data = bot.download_file(bot.get_file(document.file_id).file_path)
+    lines = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8', errors='replace')
+    if (document.file_name or '').lower().endswith('.ics') or document.mime_type == 'text/calendar':
+        items = task_import.parse_ics(lines, user.tz_name)
+    else:
+        today = datetime.datetime.now(gettz(user.tz_name)).date()
+        items = task_import.parse_text(lines, user.tz_name, today)
+    send_import_report(user, items)
+
+
+def send_import_report(user, items):
+    imported, report = task_import.import_tasks(user, items)
+    sender.invalidate(user.user_id)
+    text = '\n'.join([f'Импортировано задач: {imported} из {len(report)}.'] + report)
+    for part in taskutils.split_message(text):
+        replies.send_message(user.user_id, part)
+    user.state = states.MAIN_STATE
+
+
 def random_task_handler(message):
     user = get_user_data(message.from_user.id)
     output_message = f'Хватит дурачиться, займись делом.'
@@ -136,7 +345,7 @@ def random_task_handler(message):
         task = random.choice(future_tasks)
         output_message += f'\nНапример, {taskutils.task_to_string(task, user.tz_name, with_date=True)}'
 
-    bot.send_message(user.user_id, output_message)
+    replies.send_message(user.user_id, output_message)
     user.state = states.MAIN_STATE
 
 
@@ -151,11 +360,13 @@ def dispatcher(message):
         enter_added_task_name_handler(message)
     elif state == states.RANDOM_TASK_STATE:
         random_task_handler(message)
+    elif state == states.IMPORT_STATE:
+        import_text_handler(message, message.text)
     else:
         if not user.service:
             no_auth_handler(message)
             return
-        bot.send_message(user.user_id, 'Не понял, повтори...')
+        replies.send_message(user.user_id, 'Не понял, повтори...')
         user.state = states.RANDOM_TASK_STATE
 
 
@@ -165,41 +376,94 @@ def markup_handler(call):
     state = user.state
 
     if state == states.DELETE_TASK_SUCCESS_STATE:
-        tasks_data = call.data.split(':')
-        user.remove_task(tasks_data[1])
-        bot.edit_message_text('Задача удалена.', user.user_id, call.message.message_id)
+        action, args = callback_codec.decode(call.data)
+        if action != 'delete':
+            return
+        user.remove_task(args[0])
+        sender.invalidate(user.user_id)
+        replies.edit_message_text('Задача удалена.', user.user_id, call.message.message_id)
         user.state = states.MAIN_STATE
         return
 
-    dt = keyboard.keyboard_handler(bot, call)
+    dt = keyboard.keyboard_handler(replies, call)
     if dt:
         if state == states.TASKS_STATE:
             tasks = user.get_day_tasks(dt.date())
-            bot.edit_message_text(taskutils.tasks_to_string(tasks, user.tz_name),
-                                  user.user_id,
-                                  call.message.message_id,
-                                  parse_mode='MARKDOWN')
+            replies.edit_message_text(taskutils.tasks_to_string(tasks, user.tz_name),
+                                      user.user_id,
+                                      call.message.message_id,
+                                      parse_mode='MARKDOWN')
             user.state = states.MAIN_STATE
         elif state == states.ENTER_ADDED_TASK_DATE_STATE:
             user.add_task(user.current_task_name, dt)
-            bot.edit_message_text('Задача *{0} {1}* добавлена в список.'.format(dt.strftime('%d.%m.%Y %H:%M'),
-                                                                                user.current_task_name),
-                                  user.user_id,
-                                  call.message.message_id,
-                                  parse_mode='MARKDOWN')
+            sender.invalidate(user.user_id)
+            replies.edit_message_text('Задача *{0} {1}* добавлена в список.'.format(dt.strftime('%d.%m.%Y %H:%M'),
+                                                                                    user.current_task_name),
+                                      user.user_id,
+                                      call.message.message_id,
+                                      parse_mode='MARKDOWN')
             user.state = states.MAIN_STATE
         elif state == states.DELETE_TASK_STATE:
             tasks = user.get_day_tasks(dt.date())
             if not tasks:
-                bot.edit_message_text('Задач на выбранную дату нет.', user.user_id, call.message.message_id)
+                replies.edit_message_text('Задач на выбранную дату нет.', user.user_id, call.message.message_id)
             markup = keyboard.create_tasks_list(tasks, user.tz_name)
-            bot.edit_message_text('Выберите задачу для удаления:',
-                                  user.user_id,
-                                  call.message.message_id,
-                                  reply_markup=markup)
+            replies.edit_message_text('Выберите задачу для удаления:',
+                                      user.user_id,
+                                      call.message.message_id,
+                                      reply_markup=markup)
             user.state = states.DELETE_TASK_SUCCESS_STATE
 
 
-sender = NotifySender(bot, data)
-sender.start()
-bot.polling()
+leases = ShardLeases(redis_db, on_change=lambda acquired, lost: sender.on_shards_changed(acquired, lost))
+sender = NotifySender(send_queue.client(REMINDER), users, leases)
+watcher = watch.CalendarWatcher(users, leases)
+
+
+def set_webhook(url, secret_token):
+    # pyTelegramBotAPI 3.7.3 (requirements.txt) не передает secret_token в bot.set_webhook, поэтому
+    # запрос отправляется через apihelper._make_request. После обновления telebot заменить на bot.set_webhook.
+    telebot.apihelper._make_request(TELEGRAM_TOKEN, 'setWebhook', method='post',
+                                    params={'url': url, 'secret_token': secret_token})
+
+
+def main():
+    if BOT_MODE == 'webhook' and not WEBHOOK_SECRET:
+        # Без секрета любой может отправить на webhook обновление от имени любого пользователя
+        raise SystemExit('WEBHOOK_SECRET is required in webhook mode')
+    if watch.WATCH_URL and not watch.WATCH_TOKEN:
+        # Без токена любой может отправить уведомление от имени канала и вызвать синхронизацию пользователя
+        raise SystemExit('WATCH_TOKEN is required when WATCH_URL is set')
+    if METRICS_PORT:
+        metrics.start_server(METRICS_HOST, METRICS_PORT)
+    token_refresher.start()
+    users.hydrate()
+    send_queue.start()
+    leases.start()
+    sender.start()
+    routes = {}
+    if watch.WATCH_URL:
+        # Уведомления Google об изменениях календарей, опрос остается на случай потери уведомлений
+        routes[watch.WATCH_PATH] = watch.watch_route(watch.WATCH_TOKEN, sender.invalidate)
+        watcher.start()
+    if BOT_MODE == 'webhook':
+        routes[WEBHOOK_PATH] = telegram_route(WEBHOOK_SECRET, submit_update_json)
+    # Порт занимается только при наличии маршрутов: реплики в режиме polling на одном хосте не конфликтуют
+    server = None
+    if routes:
+        server = WebhookServer(('', PORT))
+        for path, handler in routes.items():
+            server.add_route(path, handler)
+    if BOT_MODE == 'webhook':
+        set_webhook(WEBHOOK_URL + WEBHOOK_PATH, WEBHOOK_SECRET)
+        startup.mark('webhook_set')
+        server.serve_forever()
+    else:
+        if server is not None:
+            server.start()
+        bot.remove_webhook()
+        bot.polling()
+
+
+if __name__ == '__main__':
+    main()
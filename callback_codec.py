@@ -0,0 +1,88 @@
+import datetime
+
+
+# Формат v1: VERSION + однобайтовый код действия + аргументы без разделителей.
+# Аргументы фиксированной ширины занимают 1 символ, переменной (дата, строка) - все оставшееся.
+# Данные без префикса версии разбираются в старом формате "действие:арг1:арг2".
+VERSION = '1'
+OLD_DT_FORMAT = '%Y.%m.%d.%H.%M'
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _encode_dt(dt):
+    minutes = (dt.replace(tzinfo=None) - EPOCH) // datetime.timedelta(minutes=1)
+    sign = '-' if minutes < 0 else ''
+    minutes = abs(minutes)
+    digits = ''
+    while True:
+        minutes, digit = divmod(minutes, 36)
+        digits = '0123456789abcdefghijklmnopqrstuvwxyz'[digit] + digits
+        if not minutes:
+            return sign + digits
+
+
+def _decode_dt(value):
+    return EPOCH + datetime.timedelta(minutes=int(value, 36))
+
+
+_OPTIONS = {'prev': 'p', 'next': 'n'}
+_PARAMS = {'year': 'y', 'month': 'M', 'day': 'd', 'hour': 'h', 'minute': 'm'}
+
+# Тип аргумента -> (ширина или None, кодирование, декодирование, декодирование старого формата)
+FIELDS = {
+    'dt': (None, _encode_dt, _decode_dt, lambda value: datetime.datetime.strptime(value, OLD_DT_FORMAT)),
+    'flag': (1, lambda value: '1' if value else '0', lambda value: value == '1', lambda value: value == 'True'),
+    'option': (1, _OPTIONS.__getitem__, {v: k for k, v in _OPTIONS.items()}.__getitem__, str),
+    'param': (1, _PARAMS.__getitem__, {v: k for k, v in _PARAMS.items()}.__getitem__, str),
+    'str': (None, str, str, str)
+}
+
+# Действие -> (код, типы аргументов)
+ACTIONS = {
+    'empty': ('e', ()),
+    'dt': ('d', ('dt',)),
+    'calendar': ('c', ('dt',)),
+    'calendar_day': ('D', ('dt', 'flag')),
+    'calendar_month': ('m', ('option', 'dt', 'flag')),
+    'today': ('t', ('dt', 'flag')),
+    'tomorrow': ('T', ('dt', 'flag')),
+    'edit': ('E', ('param', 'option', 'dt')),
+    'delete': ('x', ('str',))
+}
+CODES = {code: (action, fields) for action, (code, fields) in ACTIONS.items()}
+
+
+def encode(action, *args):
+    code, fields = ACTIONS[action]
+    return VERSION + code + ''.join(FIELDS[field][1](arg) for field, arg in zip(fields, args))
+
+
+def decode(data):
+    if not data:
+        return None, ()
+    if data[0] != VERSION:
+        return _decode_old(data)
+
+    action, fields = CODES.get(data[1:2], (None, ()))
+    if action is None:
+        return None, ()
+    payload = data[2:]
+    variable_width = len(payload) - sum(FIELDS[field][0] or 0 for field in fields)
+    args = []
+    pos = 0
+    for field in fields:
+        width, _, decode_field, _ = FIELDS[field]
+        width = width or variable_width
+        args.append(decode_field(payload[pos:pos + width]))
+        pos += width
+    return action, tuple(args)
+
+
+def _decode_old(data):
+    action, *values = data.split(':')
+    if action not in ACTIONS:
+        return None, ()
+    fields = ACTIONS[action][1]
+    if action == 'delete':
+        values = [':'.join(values)]
+    return action, tuple(FIELDS[field][3](value) for field, value in zip(fields, values))
@@ -0,0 +1,73 @@
+from collections import deque
+from threading import Thread, Condition
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateDispatcher:
+    # Обновления одного пользователя обрабатываются строго по очереди,
+    # обновления разных пользователей - параллельно в пуле потоков
+    def __init__(self, handler, key, workers, backlog):
+        self._handler = handler
+        self._key = key
+        self._backlog = backlog
+        self._condition = Condition()
+        # Ключ -> очередь обновлений (первое - обрабатываемое)
+        self._queues = {}
+        # Ключи, готовые к обработке
+        self._ready = deque()
+        self._size = 0
+        for _ in range(workers):
+            Thread(target=self._work, daemon=True).start()
+
+    def depth(self):
+        with self._condition:
+            return self._size
+
+    def submit(self, update):
+        self._put(update, block=True)
+
+    def try_submit(self, update):
+        return self._put(update, block=False)
+
+    def _put(self, update, block):
+        key = self._key(update)
+        with self._condition:
+            while self._size >= self._backlog:
+                if not block:
+                    return False
+                self._condition.wait()
+            self._size += 1
+            queue = self._queues.get(key)
+            if queue is None:
+                self._queues[key] = deque([update])
+                self._ready.append(key)
+                self._condition.notify_all()
+            else:
+                queue.append(update)
+        return True
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._ready:
+                    self._condition.wait()
+                key = self._ready.popleft()
+                update = self._queues[key][0]
+
+            try:
+                self._handler(update)
+            except Exception:
+                logger.exception('Failed to process update for %s', key)
+
+            with self._condition:
+                queue = self._queues[key]
+                queue.popleft()
+                self._size -= 1
+                if queue:
+                    self._ready.append(key)
+                else:
+                    del self._queues[key]
+                self._condition.notify_all()
@@ -0,0 +1,269 @@
+from concurrent.futures import ThreadPoolExecutor
+import bisect
+import heapq
+import itertools
+import logging
+import os
+import time
+from threading import Lock
+
+from dateutil.tz import gettz
+from googleapiclient.errors import HttpError
+
+import governor
+from taskutils import Task
+
+
+logger = logging.getLogger(__name__)
+
+# Количество потоков предварительной синхронизации
+PREFETCH_WORKERS = int(os.environ.get('PREFETCH_WORKERS', 4))
+_prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+
+
+class MissingBatchResponse(Exception):
+    pass
+
+
+class CalendarEvents:
+    def __init__(self, calendar_id, tz):
+        self.calendar_id = calendar_id
+        # Зона, в которой хранится начало событий на весь день
+        self.tz = tz
+        self.sync_token = None
+        # id -> Task
+        self._tasks = {}
+        # Отсортированный список (начало UTC, id)
+        self._index = None
+        self._max_duration = 0
+
+    def clear(self):
+        self.sync_token = None
+        self._tasks = {}
+        self._index = None
+
+    def apply(self, events):
+        # События преобразуются в Task один раз, при получении от Google
+        for event in events:
+            if event.get('status') == 'cancelled':
+                self._tasks.pop(event['id'], None)
+            else:
+                self._tasks[event['id']] = Task.from_event(event, self.calendar_id, self.tz)
+        self._index = None
+
+    def get(self, task_id):
+        return self._tasks.get(task_id)
+
+    def _get_index(self):
+        if self._index is None:
+            self._index = sorted((task.start, task_id) for task_id, task in self._tasks.items())
+            self._max_duration = max((task.end - task.start for task in self._tasks.values()), default=0)
+        return self._index
+
+    def iter_range(self, min_ts, max_ts):
+        # Индекс фиксируется при вызове, задачи выдаются по возрастанию начала по мере чтения
+        index = self._get_index()
+        lo = bisect.bisect_left(index, (min_ts - self._max_duration,))
+        return self._iter_index(index, self._tasks, lo, min_ts, max_ts)
+
+    @staticmethod
+    def _iter_index(index, tasks, lo, min_ts, max_ts):
+        for i in range(lo, len(index)):
+            start, task_id = index[i]
+            if start >= max_ts:
+                return
+            # Задача могла быть удалена синхронизацией во время чтения
+            task = tasks.get(task_id)
+            if task is not None and task.end > min_ts:
+                yield task
+
+
+class SyncJob:
+    def __init__(self, calendar):
+        self.calendar = calendar
+        self.full_sync = calendar.sync_token is None
+        self.events = []
+        self._page_token = None
+        self.attempts = 0
+
+    def restart(self):
+        self.full_sync = True
+        self.events = []
+        self._page_token = None
+
+    def params(self, calendar_id, page_size):
+        params = {'calendarId': calendar_id, 'singleEvents': True, 'maxResults': page_size}
+        if not self.full_sync:
+            params['syncToken'] = self.calendar.sync_token
+        if self._page_token:
+            params['pageToken'] = self._page_token
+        return params
+
+    def add_page(self, response):
+        self.events.extend(response.get('items', []))
+        self._page_token = response.get('nextPageToken')
+        if self._page_token:
+            return False
+
+        if self.full_sync:
+            self.calendar.clear()
+        self.calendar.apply(self.events)
+        self.calendar.sync_token = response.get('nextSyncToken')
+        return True
+
+
+class EventStore:
+    # Минимальный интервал между синхронизациями с Google (сек)
+    SYNC_INTERVAL = 30
+    # Интервал синхронизации, если изменения календарей приходят через push-каналы (сек)
+    WATCHED_SYNC_INTERVAL = 15 * 60
+    PAGE_SIZE = 2500
+    # Максимальное количество запросов в одном batch-запросе Google
+    BATCH_SIZE = 50
+
+    def __init__(self, user):
+        self._user = user
+        self._lock = Lock()
+        self._calendars = {}
+        self._synced_at = 0
+        self._invalidations = 0
+        self._tz_name = None
+        # Для всех календарей пользователя открыты push-каналы
+        self.watched = False
+
+    def invalidate(self):
+        self._synced_at = 0
+        self._invalidations += 1
+
+    def detach(self):
+        with self._lock:
+            self._user = None
+        return self
+
+    def attach(self, user):
+        with self._lock:
+            self._user = user
+            # Каналы могли закрыться, пока пользователь был выгружен; признак восстановит CalendarWatcher
+            self.watched = False
+        return self
+
+    def prefetch(self):
+        # Синхронизация заранее, пока пользователь выбирает дату: следующий запрос обслуживается из памяти
+        _prefetch_executor.submit(self._prefetch)
+
+    def _prefetch(self):
+        try:
+            self.sync()
+        except Exception:
+            logger.exception('Failed to prefetch events')
+
+    def reset(self):
+        with self._lock:
+            self._calendars = {}
+            self._synced_at = 0
+            self.watched = False
+
+    def sync(self, force=False):
+        with self._lock:
+            interval = self.WATCHED_SYNC_INTERVAL if self.watched else self.SYNC_INTERVAL
+            if not force and time.time() - self._synced_at < interval:
+                return
+            synced_at = time.time()
+            invalidations = self._invalidations
+            calendar_ids = [calendar['id'] for calendar in self._user.get_calendars()]
+            if self._tz_name != self._user.tz_name:
+                # События на весь день хранятся как полночь в зоне пользователя - при смене зоны загружаются заново
+                self._tz_name = self._user.tz_name
+                self._calendars = {}
+            tz = gettz(self._tz_name)
+            for calendar_id in set(self._calendars) - set(calendar_ids):
+                del self._calendars[calendar_id]
+            for calendar_id in calendar_ids:
+                self._calendars.setdefault(calendar_id, CalendarEvents(calendar_id, tz))
+            self._sync_calendars(calendar_ids)
+            # Инвалидация во время синхронизации могла сообщить о более позднем изменении
+            if self._invalidations == invalidations:
+                self._synced_at = synced_at
+
+    def _sync_calendars(self, calendar_ids):
+        # Первая синхронизация загружает все события, последующие - только изменения по syncToken.
+        # Запросы ко всем календарям отправляются одним batch-запросом, следующие страницы - следующим.
+        jobs = {calendar_id: SyncJob(self._calendars[calendar_id]) for calendar_id in calendar_ids}
+        # id события -> id календаря, None - событие удалено
+        event_calendars = {}
+        error = None
+        retry_attempt = None
+        while jobs:
+            if retry_attempt is not None:
+                time.sleep(governor.backoff(retry_attempt))
+                retry_attempt = None
+            batch_ids = list(jobs)[:self.BATCH_SIZE]
+            responses = {}
+
+            def callback(request_id, response, exception):
+                responses[request_id] = (response, exception)
+
+            batch = self._user.service.new_batch_http_request(callback=callback)
+            for calendar_id in batch_ids:
+                batch.add(self._user.service.events().list(**jobs[calendar_id].params(calendar_id, self.PAGE_SIZE)),
+                          request_id=calendar_id)
+            self._user.execute(batch, tokens=len(batch_ids))
+
+            for calendar_id in batch_ids:
+                job = jobs[calendar_id]
+                response, exception = responses.get(calendar_id, (None, None))
+                if response is None and exception is None:
+                    # В ответе batch-запроса нет ответа календаря - запрос повторяется, как при временной ошибке
+                    exception = MissingBatchResponse(calendar_id)
+                if exception is not None:
+                    status = exception.resp.status if isinstance(exception, HttpError) else None
+                    if status == 410 and not job.full_sync:
+                        # Токен синхронизации устарел - полная синхронизация
+                        job.restart()
+                        continue
+                    retryable = governor.is_retryable(exception) or isinstance(exception, MissingBatchResponse)
+                    if retryable and job.attempts < governor.GOOGLE_MAX_RETRIES:
+                        # Запрос календаря повторяется в следующем batch-запросе
+                        retry_attempt = max(retry_attempt or 0, job.attempts)
+                        job.attempts += 1
+                        continue
+                    del jobs[calendar_id]
+                    if status == 404:
+                        # Календарь удален - список календарей в кэше устарел
+                        del self._calendars[calendar_id]
+                        self._user.invalidate_calendars()
+                    else:
+                        error = error or exception
+                elif job.add_page(response):
+                    for event in job.events:
+                        event_calendars[event['id']] = calendar_id if event.get('status') != 'cancelled' else None
+                    del jobs[calendar_id]
+        if event_calendars:
+            self._user.index_events(event_calendars)
+        if error is not None:
+            raise error
+
+    def get_calendar_id(self, task_id):
+        # Календарь задачи по уже загруженным событиям, без запросов к Google
+        with self._lock:
+            for calendar in self._calendars.values():
+                if calendar.get(task_id) is not None:
+                    return calendar.calendar_id
+        return None
+
+    def iter_range(self, min_date_time, max_date_time):
+        self.sync()
+        return self._iter_range(min_date_time.timestamp(), max_date_time.timestamp())
+
+    def _iter_range(self, min_ts, max_ts):
+        # Слияние отсортированных задач календарей: задачи читаются только по мере необходимости
+        with self._lock:
+            iterators = [calendar.iter_range(min_ts, max_ts) for calendar in self._calendars.values()]
+        return heapq.merge(*iterators, key=lambda task: task.start)
+
+    def get_range(self, min_date_time, max_date_time):
+        return list(self.iter_range(min_date_time, max_date_time))
+
+    def get_future(self, limit):
+        self.sync()
+        return list(itertools.islice(self._iter_range(time.time(), float('inf')), limit))
@@ -0,0 +1,130 @@
+from contextlib import contextmanager
+import json
+import os
+import random
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+
+import metrics
+from ratelimit import TokenBucket
+
+
+# Ограничения запросов к Google Calendar API (запросов в секунду)
+GOOGLE_GLOBAL_RATE = float(os.environ.get('GOOGLE_GLOBAL_RATE', 50))
+GOOGLE_USER_RATE = float(os.environ.get('GOOGLE_USER_RATE', 5))
+# Доля общего лимита, недоступная фоновым запросам
+GOOGLE_INTERACTIVE_RESERVE = float(os.environ.get('GOOGLE_INTERACTIVE_RESERVE', 0.3))
+GOOGLE_MAX_RETRIES = int(os.environ.get('GOOGLE_MAX_RETRIES', 5))
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 32
+# Интерактивный запрос выполняется в потоке обработки обновлений и не должен долго ждать повтора
+INTERACTIVE_BACKOFF_MAX = 2
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RETRYABLE_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded', 'backendError'}
+
+_global_bucket = TokenBucket(GOOGLE_GLOBAL_RATE)
+_local = threading.local()
+
+CALLS = metrics.Counter('google_api_calls_total', 'Google Calendar API calls', ['method', 'status'])
+CALL_SECONDS = metrics.Histogram('google_api_call_seconds', 'Google Calendar API call latency', ['method'])
+
+
+def get_error_reason(error):
+    try:
+        return json.loads(error.content)['error']['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+
+def is_retryable(error):
+    if isinstance(error, HttpError):
+        status = error.resp.status
+        if status == 403:
+            return get_error_reason(error) in RETRYABLE_REASONS
+        return status in RETRYABLE_STATUSES
+    # Сетевые ошибки requests и таймауты
+    return isinstance(error, OSError)
+
+
+def backoff(attempt):
+    # Экспоненциальная задержка со случайным разбросом
+    limit = BACKOFF_MAX if _get_priority() == BACKGROUND else INTERACTIVE_BACKOFF_MAX
+    return random.uniform(0, min(limit, BACKOFF_BASE * 2 ** attempt))
+
+
+def user_bucket():
+    return TokenBucket(GOOGLE_USER_RATE)
+
+
+@contextmanager
+def background():
+    # Запросы фоновых задач (напоминания, синхронизация) уступают лимит интерактивным
+    previous = _get_priority()
+    _local.priority = BACKGROUND
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def _get_priority():
+    return getattr(_local, 'priority', INTERACTIVE)
+
+
+def _acquire(bucket, tokens):
+    # Batch-запрос не уводит лимит пользователя в долг, иначе следующий интерактивный
+    # запрос пользователя ждал бы, пока восстановятся токены всего batch-запроса
+    if _get_priority() == INTERACTIVE:
+        bucket.take(min(tokens, bucket.capacity))
+        _global_bucket.take(tokens)
+        return
+    _take_background(bucket, min(tokens, bucket.capacity * (1 - GOOGLE_INTERACTIVE_RESERVE)))
+    _take_background(_global_bucket, tokens)
+
+
+def _take_background(bucket, tokens):
+    # Фоновый запрос оставляет в лимите резерв для интерактивных. Batch-запрос больше доступной
+    # фоновым запросам части лимита списывается частями: delay ограничивает запрос емкостью,
+    # и списание целиком забрало бы резерв.
+    reserve = bucket.capacity * GOOGLE_INTERACTIVE_RESERVE
+    step = bucket.capacity - reserve
+    while tokens > 0:
+        part = min(tokens, step)
+        wait = bucket.delay(part + reserve)
+        if not wait and not bucket.try_take(part):
+            tokens -= part
+            continue
+        time.sleep(wait or 1 / bucket.rate)
+
+
+def get_method(request):
+    # methodId запроса googleapiclient без имени API, например events.list
+    method_id = getattr(request, 'methodId', None)
+    return method_id.split('.', 1)[-1] if method_id else 'batch'
+
+
+def execute(request, bucket, tokens=1):
+    method = get_method(request)
+    attempt = 0
+    while True:
+        _acquire(bucket, tokens)
+        start = time.perf_counter()
+        try:
+            result = request.execute()
+        except Exception as e:
+            CALL_SECONDS.labels(method).observe(time.perf_counter() - start)
+            CALLS.labels(method, e.resp.status if isinstance(e, HttpError) else 'error').inc()
+            if not is_retryable(e) or attempt >= GOOGLE_MAX_RETRIES:
+                raise
+        else:
+            CALL_SECONDS.labels(method).observe(time.perf_counter() - start)
+            CALLS.labels(method, 'ok').inc()
+            return result
+        time.sleep(backoff(attempt))
+        attempt += 1
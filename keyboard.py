@@ -1,109 +1,100 @@
 import datetime
 import calendar
+import functools
 import json
 
 from dateutil.relativedelta import relativedelta
 
+import callback_codec
 import taskutils
 
-DT_FORMAT = '%Y.%m.%d.%H.%M'
+# Размеры кэшей готовой разметки
+CALENDAR_CACHE_SIZE = 256
+WIDGET_CACHE_SIZE = 4096
 
 
 def keyboard_handler(bot, call):
-    chat_id = call.message.chat.id
-    message_id = call.message.message_id
-    calendar_data = call.data.split(':')
-
-    if not calendar_data:
-        pass
-    elif calendar_data[0] == 'dt':
-        bot.edit_message_reply_markup(chat_id, message_id, reply_markup=None)
-        return datetime.datetime.strptime(calendar_data[1], DT_FORMAT)
-    elif calendar_data[0] == 'calendar':
-        dt = datetime.datetime.strptime(calendar_data[1], DT_FORMAT)
-        markup = create_calendar(dt, False)
-        bot.edit_message_reply_markup(chat_id, message_id, reply_markup=markup)
-    elif calendar_data[0] == 'calendar_day':
-        dt = datetime.datetime.strptime(calendar_data[1], DT_FORMAT)
-        if calendar_data[2]:
-            bot.edit_message_reply_markup(chat_id, message_id, reply_markup=None)
-            return dt
-        else:
-            markup = create_date_time_widget(dt)
-            bot.edit_message_reply_markup(chat_id, message_id, reply_markup=markup)
-    elif calendar_data[0] == 'calendar_month':
-        option = calendar_data[1]
-        dt = datetime.datetime.strptime(calendar_data[2], DT_FORMAT)
-        if option == 'prev':
-            dt -= relativedelta(months=1)
-        elif option == 'next':
-            dt += relativedelta(months=1)
-        markup = create_calendar(dt, calendar_data[3])
-        bot.edit_message_reply_markup(chat_id, message_id, reply_markup=markup)
-    elif calendar_data[0] == 'today':
-        dt = datetime.datetime.strptime(calendar_data[1], DT_FORMAT)
-        now = datetime.date.today()
-        dt = dt.replace(year=now.year, month=now.month, day=now.day)
-        if calendar_data[2]:
-            bot.edit_message_reply_markup(chat_id, message_id, reply_markup=None)
-            return dt
-        else:
-            markup = create_date_time_widget(dt)
-            bot.edit_message_reply_markup(chat_id, message_id, reply_markup=markup)
-    elif calendar_data[0] == 'tomorrow':
-        dt = datetime.datetime.strptime(calendar_data[1], DT_FORMAT)
-        now = datetime.date.today() + datetime.timedelta(days=1)
-        dt = dt.replace(year=now.year, month=now.month, day=now.day)
-        if calendar_data[2]:
-            bot.edit_message_reply_markup(chat_id, message_id, reply_markup=None)
-            return dt
-        else:
-            markup = create_date_time_widget(dt)
-            bot.edit_message_reply_markup(chat_id, message_id, reply_markup=markup)
-    elif calendar_data[0] == 'edit':
-        state = calendar_data[1]
-        option = calendar_data[2]
-        dt = datetime.datetime.strptime(calendar_data[3], DT_FORMAT)
-        if option == 'prev':
-            if state == 'year':
-                dt -= relativedelta(years=1)
-            elif state == 'month':
-                dt -= relativedelta(months=1)
-            elif state == 'day':
-                dt -= relativedelta(days=1)
-            elif state == 'hour':
-                dt -= relativedelta(hours=1)
-            elif state == 'minute':
-                dt -= relativedelta(minutes=1)
-        elif option == 'next':
-            if state == 'year':
-                dt += relativedelta(years=1)
-            elif state == 'month':
-                dt += relativedelta(months=1)
-            elif state == 'day':
-                dt += relativedelta(days=1)
-            elif state == 'hour':
-                dt += relativedelta(hours=1)
-            elif state == 'minute':
-                dt += relativedelta(minutes=1)
-        markup = create_date_time_widget(dt)
-        bot.edit_message_reply_markup(chat_id, message_id, reply_markup=markup)
-    elif calendar_data[0] == 'empty':
-        bot.answer_callback_query(call.id)
-
-    return None
-
-
-def create_callback_data(*args):
-    return ':'.join(str(arg) for arg in args)
+    action, args = callback_codec.decode(call.data)
+    handler = CALLBACK_HANDLERS.get(action)
+    if handler is None:
+        return None
+    return handler(bot, call, *args)
+
+
+def _edit_markup(bot, call, markup):
+    bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=markup)
+
+
+def _on_dt(bot, call, dt):
+    _edit_markup(bot, call, None)
+    return dt
+
+
+def _on_calendar(bot, call, dt):
+    _edit_markup(bot, call, create_calendar(dt, False))
+
+
+def _on_calendar_day(bot, call, dt, only_calendar):
+    if only_calendar:
+        _edit_markup(bot, call, None)
+        return dt
+    _edit_markup(bot, call, create_date_time_widget(dt))
+
+
+def _on_calendar_month(bot, call, option, dt, only_calendar):
+    dt += MONTH_STEPS[option]
+    _edit_markup(bot, call, create_calendar(dt, only_calendar))
+
+
+def _on_day_shift(days):
+    def handler(bot, call, dt, only_calendar):
+        day = datetime.date.today() + datetime.timedelta(days=days)
+        return _on_calendar_day(bot, call, dt.replace(year=day.year, month=day.month, day=day.day), only_calendar)
+    return handler
+
+
+def _on_edit(bot, call, param, option, dt):
+    step = EDIT_STEPS[param]
+    dt = dt + step if option == 'next' else dt - step
+    _edit_markup(bot, call, create_date_time_widget(dt))
+
+
+def _on_empty(bot, call):
+    bot.answer_callback_query(call.id)
+
+
+MONTH_STEPS = {'prev': relativedelta(months=-1), 'next': relativedelta(months=1)}
+EDIT_STEPS = {
+    'year': relativedelta(years=1),
+    'month': relativedelta(months=1),
+    'day': relativedelta(days=1),
+    'hour': relativedelta(hours=1),
+    'minute': relativedelta(minutes=1)
+}
+CALLBACK_HANDLERS = {
+    'dt': _on_dt,
+    'calendar': _on_calendar,
+    'calendar_day': _on_calendar_day,
+    'calendar_month': _on_calendar_month,
+    'today': _on_day_shift(0),
+    'tomorrow': _on_day_shift(1),
+    'edit': _on_edit,
+    'empty': _on_empty
+}
 
 
 def create_calendar(dt, only_calendar=True):
-    empty_callback_data = create_callback_data('empty')
+    # Разметка зависит только от месяца и времени, поэтому кэшируется уже сериализованной
+    return _render_calendar(dt.year, dt.month, dt.hour, dt.minute, bool(only_calendar))
+
+
+@functools.lru_cache(maxsize=CALENDAR_CACHE_SIZE)
+def _render_calendar(year, month, hour, minute, only_calendar):
+    empty_callback_data = callback_codec.encode('empty')
     markup = {'inline_keyboard': []}
 
     # Год, месяц
-    row = [{'text': f'{calendar.month_name[dt.month]} {str(dt.year)}', 'callback_data': empty_callback_data}]
+    row = [{'text': f'{calendar.month_name[month]} {str(year)}', 'callback_data': empty_callback_data}]
     markup['inline_keyboard'].append(row)
 
     # Дни недели
@@ -113,7 +104,8 @@ def create_calendar(dt, only_calendar=True):
     markup['inline_keyboard'].append(row)
 
     # Календарь
-    month_calendar = calendar.monthcalendar(dt.year, dt.month)
+    dt = datetime.datetime(year, month, 1, hour, minute)
+    month_calendar = calendar.monthcalendar(year, month)
     for week in month_calendar:
         row = []
         for day in week:
@@ -121,39 +113,33 @@ def create_calendar(dt, only_calendar=True):
                 row.append({'text': ' ', 'callback_data': empty_callback_data})
             else:
                 dt = dt.replace(day=day)
-                row.append({'text': str(day), 'callback_data': create_callback_data('calendar_day',
-                                                                                    dt.strftime(DT_FORMAT),
-                                                                                    only_calendar)})
+                row.append({'text': str(day),
+                            'callback_data': callback_codec.encode('calendar_day', dt, only_calendar)})
         markup['inline_keyboard'].append(row)
 
     # Кнопки переключения
-    row = [{'text': '<', 'callback_data': create_callback_data('calendar_month',
-                                                               'prev',
-                                                               dt.strftime(DT_FORMAT),
-                                                               only_calendar)},
-           {'text': '>', 'callback_data': create_callback_data('calendar_month',
-                                                               'next',
-                                                               dt.strftime(DT_FORMAT),
-                                                               only_calendar)}]
+    row = [{'text': '<', 'callback_data': callback_codec.encode('calendar_month', 'prev', dt, only_calendar)},
+           {'text': '>', 'callback_data': callback_codec.encode('calendar_month', 'next', dt, only_calendar)}]
     markup['inline_keyboard'].append(row)
 
     # Сегодня, завтра
-    row = [{'text': 'Сегодня', 'callback_data': create_callback_data('today',
-                                                                     dt.strftime(DT_FORMAT),
-                                                                     only_calendar)},
-           {'text': 'Завтра', 'callback_data': create_callback_data('tomorrow',
-                                                                    dt.strftime(DT_FORMAT),
-                                                                    only_calendar)}]
+    row = [{'text': 'Сегодня', 'callback_data': callback_codec.encode('today', dt, only_calendar)},
+           {'text': 'Завтра', 'callback_data': callback_codec.encode('tomorrow', dt, only_calendar)}]
     markup['inline_keyboard'].append(row)
 
     return json.dumps(markup)
 
 
 def create_date_time_widget(dt):
+    return _render_date_time_widget(dt.year, dt.month, dt.day, dt.hour, dt.minute)
+
+
+@functools.lru_cache(maxsize=WIDGET_CACHE_SIZE)
+def _render_date_time_widget(year, month, day, hour, minute):
     markup = {'inline_keyboard': []}
     params = ['day', 'month', 'year', 'hour', 'minute']
-    dt_str = dt.strftime(DT_FORMAT)
-    empty_callback_data = create_callback_data('empty')
+    dt = datetime.datetime(year, month, day, hour, minute)
+    empty_callback_data = callback_codec.encode('empty')
 
     # Заголовки
     headers = ['День', 'Месяц', 'Год', 'Час', 'Минута']
@@ -161,27 +147,27 @@ def create_date_time_widget(dt):
     markup['inline_keyboard'].append(row)
 
     # Инкремент
-    row = [{'text': '▲', 'callback_data': create_callback_data('edit', param, 'next', dt_str)} for param in params]
+    row = [{'text': '▲', 'callback_data': callback_codec.encode('edit', param, 'next', dt)} for param in params]
     markup['inline_keyboard'].append(row)
 
     # Дата, время
-    row = [{'text': str(dt.day), 'callback_data': empty_callback_data},
-           {'text': str(dt.month), 'callback_data': empty_callback_data},
-           {'text': str(dt.year), 'callback_data': empty_callback_data},
-           {'text': str(dt.hour), 'callback_data': empty_callback_data},
-           {'text': str(dt.minute), 'callback_data': empty_callback_data}]
+    row = [{'text': str(day), 'callback_data': empty_callback_data},
+           {'text': str(month), 'callback_data': empty_callback_data},
+           {'text': str(year), 'callback_data': empty_callback_data},
+           {'text': str(hour), 'callback_data': empty_callback_data},
+           {'text': str(minute), 'callback_data': empty_callback_data}]
     markup['inline_keyboard'].append(row)
 
     # Декремент
-    row = [{'text': '▼', 'callback_data': create_callback_data('edit', param, 'prev', dt_str)} for param in params]
+    row = [{'text': '▼', 'callback_data': callback_codec.encode('edit', param, 'prev', dt)} for param in params]
     markup['inline_keyboard'].append(row)
 
     # Календарь
-    row = [{'text': 'Календарь', 'callback_data': create_callback_data('calendar', dt_str)}]
+    row = [{'text': 'Календарь', 'callback_data': callback_codec.encode('calendar', dt)}]
     markup['inline_keyboard'].append(row)
 
     # Готово
-    row = [{'text': 'Готово', 'callback_data': create_callback_data('dt', dt_str)}]
+    row = [{'text': 'Готово', 'callback_data': callback_codec.encode('dt', dt)}]
     markup['inline_keyboard'].append(row)
 
     return json.dumps(markup)
@@ -191,7 +177,8 @@ def create_tasks_list(tasks, tz_name):
     markup = {'inline_keyboard': []}
     for task in tasks:
         row = [
-            {'text': taskutils.task_to_string(task, tz_name), 'callback_data': create_callback_data('delete', task['id'])}
+            {'text': taskutils.task_to_string(task, tz_name),
+             'callback_data': callback_codec.encode('delete', task.id)}
         ]
         markup['inline_keyboard'].append(row)
     return json.dumps(markup)
@@ -1,32 +1,279 @@
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Condition
 import datetime
-from time import sleep
+import functools
+import heapq
+import itertools
+import logging
+import os
+import time
 
+import governor
+import metrics
 import taskutils
+from sharding import SHARD_LEASE_TTL
+from user_data import redis_db
+
+
+# Канал инвалидации напоминаний пользователя на всех репликах
+INVALIDATION_CHANNEL = 'reminder_invalidations'
+# Время хранения ключей отправленных напоминаний (сек)
+REMINDER_KEY_TTL = 2 * 24 * 60 * 60
+# Время захвата напоминания до отправки (сек): если реплика упала, не отправив напоминание,
+# новый владелец шарда отправит его после освобождения ключа
+REMINDER_CLAIM_TTL = SHARD_LEASE_TTL
+# Повтор недоставленного напоминания (сек)
+REMINDER_RETRY_INTERVAL = 10
+# Количество потоков обновления задач пользователей: запросы к Google не задерживают отправку напоминаний
+REFRESH_WORKERS = int(os.environ.get('NOTIFY_REFRESH_WORKERS', 4))
+
+
+logger = logging.getLogger(__name__)
+
+PASS_SECONDS = metrics.Histogram('notifier_pass_seconds', 'Duration of a notifier refresh and send pass')
+LATENESS_SECONDS = metrics.Histogram('reminder_lateness_seconds', 'Reminder delivery time after the event start',
+                                     buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
 
 
 class NotifySender(Thread):
-    SLEEP_TIMEOUT = 10
+    # Горизонт, на который заранее загружаются задачи пользователя
+    HORIZON = datetime.timedelta(hours=3)
+    # Интервал обновления горизонта пользователя (сек)
+    REFRESH_INTERVAL = 15 * 60
+    # Повтор обновления после ошибки (сек)
+    RETRY_INTERVAL = 60
+    # Интервал поиска новых пользователей (сек)
+    SCAN_INTERVAL = 10
+    # Максимальное количество пользователей, одновременно ожидающих обновления в потоках обновления
+    REFRESH_BATCH = 50
+    # Допустимое опоздание напоминания (сек), покрывает захват шардов упавшей реплики
+    GRACE = 2 * SHARD_LEASE_TTL + 60
 
-    def __init__(self, bot, data):
-        Thread.__init__(self)
-        self._last_time = None
+    def __init__(self, bot, users, leases):
+        Thread.__init__(self, daemon=True)
         self._bot = bot
-        self._data = data
+        self._users = users
+        self._leases = leases
+        self._condition = Condition()
+        self._seq = itertools.count()
+        # (время отправки UTC, seq, user_id, поколение, задача, зона пользователя)
+        self._reminders = []
+        # (время обновления, user_id)
+        self._refreshes = []
+        self._refresh_due = {}
+        # Пользователи, обновление которых выполняется, и пользователи, которых нужно обновить повторно после него
+        self._refreshing = set()
+        self._refresh_again = set()
+        self._executor = ThreadPoolExecutor(max_workers=REFRESH_WORKERS)
+        self._generations = {}
+        self._sent = {}
+        self._next_scan = 0
+
+    def invalidate(self, user_id):
+        # Пользователь может принадлежать шарду другой реплики
+        redis_db.publish(INVALIDATION_CHANNEL, user_id)
+
+    def on_shards_changed(self, acquired, lost):
+        # Пользователи захваченных шардов будут найдены при ближайшем поиске
+        with self._condition:
+            self._next_scan = 0
+            self._condition.notify()
+
+    def refresh_now(self):
+        # Обновление всех пользователей реплики в текущем потоке без ожидания интервала обновления
+        start = time.time()
+        with self._condition:
+            for user_id in self._users.user_ids():
+                if self._leases.owns(user_id):
+                    self._schedule_refresh(user_id, start)
+        while True:
+            with self._condition:
+                if not self._refreshes or self._refreshes[0][0] > start:
+                    return
+            self._refresh_due_users()
+
+    def pending_reminders(self):
+        with self._condition:
+            return len(self._reminders)
+
+    def _on_invalidation(self, message):
+        user_id = int(message['data'])
+        # Кэш событий сбрасывается на всех репликах, напоминания обновляет владелец шарда
+        user = self._users.peek(user_id)
+        if user is not None:
+            user.events.invalidate()
+        if not self._leases.owns(user_id):
+            return
+        with self._condition:
+            self._schedule_refresh(user_id, time.time())
+            self._condition.notify()
 
     def run(self):
-        self._last_time = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
+        pubsub = redis_db.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{INVALIDATION_CHANNEL: self._on_invalidation})
+        pubsub.run_in_thread(sleep_time=1, daemon=True)
         while True:
-            current_time = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc) + \
-                           datetime.timedelta(seconds=self.SLEEP_TIMEOUT)
-            for user in self._data.values():
-                if not user.service:
+            now = time.time()
+            if now >= self._next_scan:
+                self._discover_users()
+                self._next_scan = now + self.SCAN_INTERVAL
+            start = time.perf_counter()
+            self._submit_due_refreshes()
+            self._send_due_reminders()
+            PASS_SECONDS.observe(time.perf_counter() - start)
+            self._wait()
+
+    def _schedule_refresh(self, user_id, ts):
+        self._refresh_due[user_id] = ts
+        heapq.heappush(self._refreshes, (ts, user_id))
+
+    def _discover_users(self):
+        with self._condition:
+            for user_id in self._users.user_ids():
+                if user_id not in self._refresh_due and self._leases.owns(user_id):
+                    self._schedule_refresh(user_id, time.time())
+
+    def _pop_due_refreshes(self):
+        user_ids = []
+        now = time.time()
+        with self._condition:
+            while self._refreshes and len(self._refreshing) < self.REFRESH_BATCH:
+                ts, user_id = self._refreshes[0]
+                if ts > now:
+                    break
+                heapq.heappop(self._refreshes)
+                if self._refresh_due.get(user_id) != ts:
+                    continue
+                if user_id in self._refreshing:
+                    # Задачи, полученные до инвалидации, не должны заменить более новые - повтор после обновления
+                    self._refresh_again.add(user_id)
                     continue
-                tasks = user.get_tasks(self._last_time, current_time)
-                for task in tasks:
-                    if self._last_time < taskutils.get_task_start_time_utc(task) < current_time:
-                        self._bot.send_message(user.user_id,
-                                               f'Напоминание о задаче:\n*{taskutils.task_to_string(task, user.tz_name)}*',
-                                               parse_mode='MARKDOWN')
-            self._last_time = current_time
-            sleep(self.SLEEP_TIMEOUT)
+                self._refreshing.add(user_id)
+                user_ids.append((user_id, ts))
+        return user_ids
+
+    def _submit_due_refreshes(self):
+        for user_id, due in self._pop_due_refreshes():
+            self._executor.submit(self._refresh, user_id, due)
+
+    def _refresh_due_users(self):
+        for user_id, due in self._pop_due_refreshes():
+            self._refresh(user_id, due)
+
+    def _refresh(self, user_id, due):
+        next_refresh = time.time() + self.REFRESH_INTERVAL
+        if self._leases.owns(user_id):
+            try:
+                # Пользователь, выгруженный из памяти, загружается только на время обновления
+                with governor.background(), self._users.borrow(user_id) as user:
+                    if user.service:
+                        self._refresh_user(user)
+            except Exception:
+                logger.exception('Failed to refresh reminders of user %s', user_id)
+                next_refresh = time.time() + self.RETRY_INTERVAL
+        with self._condition:
+            self._refreshing.discard(user_id)
+            if not self._leases.owns(user_id):
+                # Шард передан другой реплике
+                if self._refresh_due.get(user_id) == due:
+                    del self._refresh_due[user_id]
+            elif self._refresh_due.get(user_id) == due:
+                self._schedule_refresh(user_id, next_refresh)
+            elif user_id in self._refresh_again:
+                # Во время обновления пришла инвалидация - не откладываем её
+                heapq.heappush(self._refreshes, (self._refresh_due[user_id], user_id))
+            self._refresh_again.discard(user_id)
+            # Новые напоминания и освободившийся поток обновления меняют время следующей итерации
+            self._condition.notify()
+
+    def _refresh_user(self, user):
+        now = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
+        tasks = user.get_tasks(now - datetime.timedelta(seconds=self.GRACE), now + self.HORIZON)
+        min_ts = now.timestamp() - self.GRACE
+
+        with self._condition:
+            generation = self._generations.get(user.user_id, 0) + 1
+            self._generations[user.user_id] = generation
+            sent = self._sent.setdefault(user.user_id, set())
+            for key in [key for key in sent if key[1] < min_ts]:
+                sent.discard(key)
+            for task in tasks:
+                if task.start < min_ts or (task.id, task.start) in sent:
+                    continue
+                heapq.heappush(self._reminders,
+                               (task.start, next(self._seq), user.user_id, generation, task, user.tz_name))
+
+    def _pop_due_reminders(self):
+        reminders = []
+        now = time.time()
+        with self._condition:
+            while self._reminders and self._reminders[0][0] <= now:
+                _, _, user_id, generation, task, tz_name = heapq.heappop(self._reminders)
+                if self._generations.get(user_id) != generation or not self._leases.owns(user_id):
+                    continue
+                if task.start < now - self.GRACE:
+                    logger.warning('Reminder of user %s is too late to send', user_id)
+                    continue
+                key = (task.id, task.start)
+                sent = self._sent.setdefault(user_id, set())
+                if key in sent:
+                    continue
+                sent.add(key)
+                reminders.append((user_id, generation, task, tz_name))
+        return reminders
+
+    def _send_due_reminders(self):
+        for user_id, generation, task, tz_name in self._pop_due_reminders():
+            # Напоминание отправляет только реплика, первой записавшая ключ. До отправки ключ живет
+            # REMINDER_CLAIM_TTL, после отправки - REMINDER_KEY_TTL.
+            key = f'reminder_{user_id}_{task.id}_{int(task.start)}'
+            try:
+                if not redis_db.set(key, 'claimed', nx=True, ex=REMINDER_CLAIM_TTL):
+                    if redis_db.get(key) != b'sent':
+                        # Напоминание захвачено другой репликой - проверяем, отправлено ли оно, после захвата
+                        self._retry(user_id, generation, task, tz_name, REMINDER_CLAIM_TTL)
+                    continue
+            except Exception:
+                logger.exception('Failed to claim reminder for user %s', user_id)
+                self._retry(user_id, generation, task, tz_name, REMINDER_RETRY_INTERVAL)
+                continue
+            future = self._bot.send_message(user_id,
+                                            f'Напоминание о задаче:\n*{taskutils.task_to_string(task, tz_name)}*',
+                                            parse_mode='MARKDOWN')
+            future.add_done_callback(functools.partial(self._on_sent, key, user_id, generation, task, tz_name))
+
+    def _on_sent(self, key, user_id, generation, task, tz_name, future):
+        if future.exception() is None:
+            LATENESS_SECONDS.observe(max(0, time.time() - task.start))
+            try:
+                redis_db.set(key, 'sent', ex=REMINDER_KEY_TTL)
+            except Exception:
+                logger.exception('Failed to mark reminder of user %s as sent', user_id)
+            return
+        try:
+            # Напоминание не доставлено - ключ освобождается для повторной отправки
+            redis_db.delete(key)
+        except Exception:
+            logger.exception('Failed to release reminder of user %s', user_id)
+        self._retry(user_id, generation, task, tz_name, REMINDER_RETRY_INTERVAL)
+
+    def _retry(self, user_id, generation, task, tz_name, delay):
+        # Напоминание не считается отправленным: повтор остается в очереди и после обновления задач пользователя
+        with self._condition:
+            self._sent.get(user_id, set()).discard((task.id, task.start))
+            # Обновление во время отправки пропустило напоминание как отправленное - повтор получает его поколение
+            if self._generations.get(user_id, generation) > generation:
+                generation = self._generations[user_id]
+            heapq.heappush(self._reminders, (time.time() + delay, next(self._seq), user_id, generation, task, tz_name))
+            self._condition.notify()
+
+    def _wait(self):
+        with self._condition:
+            deadline = self._next_scan
+            if self._reminders:
+                deadline = min(deadline, self._reminders[0][0])
+            if self._refreshes and len(self._refreshing) < self.REFRESH_BATCH:
+                deadline = min(deadline, self._refreshes[0][0])
+            timeout = deadline - time.time()
+            if timeout > 0:
+                self._condition.wait(timeout)
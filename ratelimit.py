@@ -0,0 +1,39 @@
+from threading import Lock
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._time = time.monotonic()
+        self._lock = Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._time) * self.rate)
+        self._time = now
+
+    def delay(self, tokens=1):
+        # Время до появления нужного количества токенов, без их расхода
+        with self._lock:
+            self._refill(time.monotonic())
+            return max(0, (min(tokens, self.capacity) - self._tokens) / self.rate)
+
+    def try_take(self, tokens=1):
+        # 0, если токены получены, иначе время ожидания.
+        # Запрос больше емкости ждет полного заполнения и уводит баланс в минус.
+        with self._lock:
+            self._refill(time.monotonic())
+            needed = min(tokens, self.capacity)
+            if self._tokens >= needed:
+                self._tokens -= tokens
+                return 0
+            return (needed - self._tokens) / self.rate
+
+    def take(self, tokens=1):
+        while True:
+            wait = self.try_take(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
@@ -0,0 +1,182 @@
+from collections import deque
+from concurrent.futures import Future
+from threading import Thread, Condition
+import heapq
+import io
+import itertools
+import logging
+import os
+import time
+
+from ratelimit import TokenBucket
+
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты исходящих сообщений: ответы пользователю отправляются раньше напоминаний
+INTERACTIVE = 0
+REMINDER = 1
+
+# Ограничения Telegram: сообщений в секунду всего и в один чат
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', 30))
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', 1))
+TELEGRAM_CHAT_BURST = 3
+# Время, после которого неиспользуемый лимит чата удаляется (сек)
+CHAT_BUCKET_IDLE = 60
+# Количество потоков отправки: вызов Telegram занимает ~100 мс, один поток не выбирает общий лимит
+SEND_WORKERS = int(os.environ.get('SEND_WORKERS', 8))
+
+
+def get_retry_after(e):
+    result = getattr(e, 'result', None)
+    if result is None or getattr(result, 'status_code', None) != 429:
+        return None
+    try:
+        return result.json()['parameters']['retry_after']
+    except (ValueError, KeyError, TypeError):
+        return 1
+
+
+class SendQueue:
+    # Сообщения одного чата отправляются по порядку, чаты выбираются по приоритету первого сообщения.
+    # Чат, сообщение которого отправляется, не находится в _ready и _waiting, поэтому
+    # сообщения одного чата не отправляются параллельно.
+    def __init__(self, bot):
+        self.bot = bot
+        self._condition = Condition()
+        self._seq = itertools.count()
+        # chat_id -> очередь (приоритет, seq, future, метод, args, kwargs)
+        self._chats = {}
+        # (приоритет, seq, chat_id) - чаты, готовые к отправке
+        self._ready = []
+        # (время, seq, chat_id) - чаты, ожидающие лимита чата или retry_after
+        self._waiting = []
+        self._buckets = {}
+        self._global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE)
+        self._depth = 0
+        self._next_prune = 0
+
+    def depth(self):
+        with self._condition:
+            return self._depth
+
+    def client(self, priority):
+        return QueuedBot(self, priority)
+
+    def put(self, priority, chat_id, method, *args, **kwargs):
+        future = Future()
+        item = (priority, next(self._seq), future, method, args, kwargs)
+        with self._condition:
+            queue = self._chats.get(chat_id)
+            if queue is None:
+                self._chats[chat_id] = deque([item])
+                bucket = self._buckets.get(chat_id)
+                delay = bucket.delay() if bucket is not None else 0
+                if delay:
+                    heapq.heappush(self._waiting, (time.monotonic() + delay, item[1], chat_id))
+                else:
+                    heapq.heappush(self._ready, (item[0], item[1], chat_id))
+                self._condition.notify()
+            else:
+                queue.append(item)
+            self._depth += 1
+        return future
+
+    def start(self):
+        for _ in range(SEND_WORKERS):
+            Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            chat_id = self._next_chat()
+            with self._condition:
+                _, _, future, method, args, kwargs = self._chats[chat_id][0]
+                wait = self._get_bucket(chat_id).try_take()
+            if wait:
+                # Лимит чата еще не восстановился - чат ждет, остальные чаты продолжают обслуживаться
+                self._schedule(chat_id, time.monotonic() + wait)
+                continue
+            self._global_bucket.take()
+            try:
+                result = getattr(self.bot, method)(*args, **kwargs)
+            except Exception as e:
+                retry_after = get_retry_after(e)
+                if retry_after is not None:
+                    # Файл уже прочитан неудачной отправкой и перечитывается с начала
+                    for arg in itertools.chain(args, kwargs.values()):
+                        if isinstance(arg, io.IOBase) and arg.seekable():
+                            arg.seek(0)
+                    # Повтор того же сообщения после паузы, остальные чаты продолжают обслуживаться
+                    self._schedule(chat_id, time.monotonic() + retry_after)
+                    continue
+                logger.exception('Failed to call %s for chat %s', method, chat_id)
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+            with self._condition:
+                queue = self._chats[chat_id]
+                queue.popleft()
+                self._depth -= 1
+                if queue:
+                    self._schedule(chat_id, time.monotonic() + self._get_bucket(chat_id).delay())
+                else:
+                    del self._chats[chat_id]
+
+    def _get_bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+        bucket.used = time.monotonic()
+        return bucket
+
+    def _schedule(self, chat_id, ready_time):
+        with self._condition:
+            heapq.heappush(self._waiting, (ready_time, next(self._seq), chat_id))
+            self._condition.notify()
+
+    def _next_chat(self):
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                while self._waiting and self._waiting[0][0] <= now:
+                    _, _, chat_id = heapq.heappop(self._waiting)
+                    priority, seq = self._chats[chat_id][0][:2]
+                    heapq.heappush(self._ready, (priority, seq, chat_id))
+                if now >= self._next_prune:
+                    self._prune_buckets(now)
+                if self._ready:
+                    return heapq.heappop(self._ready)[2]
+                timeout = self._waiting[0][0] - now if self._waiting else None
+                self._condition.wait(timeout)
+
+    def _prune_buckets(self, now):
+        self._buckets = {chat_id: bucket for chat_id, bucket in self._buckets.items()
+                         if chat_id in self._chats or now - bucket.used < CHAT_BUCKET_IDLE}
+        self._next_prune = now + CHAT_BUCKET_IDLE
+
+
+class QueuedBot:
+    # Методы отправки бота, которые ставят вызов в очередь и возвращают Future
+    def __init__(self, queue, priority):
+        self._queue = queue
+        self._priority = priority
+
+    def send_message(self, chat_id, *args, **kwargs):
+        return self._queue.put(self._priority, chat_id, 'send_message', chat_id, *args, **kwargs)
+
+    def reply_to(self, message, *args, **kwargs):
+        return self._queue.put(self._priority, message.chat.id, 'reply_to', message, *args, **kwargs)
+
+    def edit_message_text(self, text, chat_id, *args, **kwargs):
+        return self._queue.put(self._priority, chat_id, 'edit_message_text', text, chat_id, *args, **kwargs)
+
+    def edit_message_reply_markup(self, chat_id, *args, **kwargs):
+        return self._queue.put(self._priority, chat_id, 'edit_message_reply_markup', chat_id, *args, **kwargs)
+
+    def send_document(self, chat_id, *args, **kwargs):
+        return self._queue.put(self._priority, chat_id, 'send_document', chat_id, *args, **kwargs)
+
+    def answer_callback_query(self, *args, **kwargs):
+        # Ответ на нажатие кнопки не является сообщением в чат и не ограничивается
+        return self._queue.bot.answer_callback_query(*args, **kwargs)
@@ -0,0 +1,100 @@
+from threading import Thread
+import logging
+import math
+import os
+import random
+import time
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+# Количество шардов напоминаний и время жизни аренды шарда (сек)
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', 64))
+SHARD_LEASE_TTL = int(os.environ.get('SHARD_LEASE_TTL', 30))
+
+NODES_KEY = 'reminder_nodes'
+
+# Продление и освобождение только собственной аренды
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def get_shard(user_id):
+    return user_id % SHARD_COUNT
+
+
+def get_lease_key(shard):
+    return f'shard_{shard}_lease'
+
+
+class ShardLeases(Thread):
+    # Распределяет шарды напоминаний между репликами через аренды в Redis.
+    # Каждая реплика держит не больше своей доли шардов, аренды умерших реплик истекают и захватываются остальными.
+    HEARTBEAT_INTERVAL = SHARD_LEASE_TTL / 3
+
+    def __init__(self, redis_db, on_change=None):
+        Thread.__init__(self, daemon=True)
+        self.node_id = uuid.uuid4().hex
+        self._redis = redis_db
+        self._on_change = on_change
+        self._owned = frozenset()
+        self._renew = redis_db.register_script(RENEW_SCRIPT)
+        self._release = redis_db.register_script(RELEASE_SCRIPT)
+
+    def owns(self, user_id):
+        return get_shard(user_id) in self._owned
+
+    def run(self):
+        while True:
+            try:
+                self.heartbeat()
+            except Exception:
+                logger.exception('Failed to renew shard leases')
+            time.sleep(self.HEARTBEAT_INTERVAL)
+
+    def heartbeat(self):
+        now = time.time()
+        ttl_ms = SHARD_LEASE_TTL * 1000
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.zadd(NODES_KEY, {self.node_id: now})
+        pipe.zremrangebyscore(NODES_KEY, 0, now - SHARD_LEASE_TTL)
+        pipe.zcard(NODES_KEY)
+        shards = sorted(self._owned)
+        for shard in shards:
+            self._renew(keys=[get_lease_key(shard)], args=[self.node_id, ttl_ms], client=pipe)
+        results = pipe.execute()
+
+        nodes = results[2]
+        owned = {shard for shard, renewed in zip(shards, results[3:]) if renewed}
+        fair_share = math.ceil(SHARD_COUNT / max(nodes, 1))
+
+        # Лишние шарды отдаются новым репликам
+        while len(owned) > fair_share:
+            shard = owned.pop()
+            self._release(keys=[get_lease_key(shard)], args=[self.node_id])
+
+        if len(owned) < fair_share:
+            free_shards = [shard for shard in range(SHARD_COUNT) if shard not in owned]
+            random.shuffle(free_shards)
+            for shard in free_shards:
+                if self._redis.set(get_lease_key(shard), self.node_id, nx=True, px=ttl_ms):
+                    owned.add(shard)
+                    if len(owned) >= fair_share:
+                        break
+
+        acquired = owned - self._owned
+        lost = self._owned - owned
+        self._owned = frozenset(owned)
+        if (acquired or lost) and self._on_change is not None:
+            self._on_change(acquired, lost)
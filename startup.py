@@ -0,0 +1,25 @@
+import logging
+import time
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Начало запуска - импорт этого модуля первым импортом bot.py
+STARTED = time.perf_counter()
+
+_stages = {}
+
+
+def mark(stage):
+    # Время от начала запуска до первого достижения этапа, доступно в логе и метриках
+    if stage in _stages:
+        return
+    seconds = _stages[stage] = time.perf_counter() - STARTED
+    metrics.Gauge(f'startup_{stage}_seconds', f'Time from process start to {stage}', lambda: seconds)
+    logger.info('Startup: %s in %.3f s', stage, seconds)
+
+
+def get_stages():
+    return dict(_stages)
@@ -6,4 +6,4 @@ ENTER_ADDED_TASK_DATE_STATE = 4
 DELETE_TASK_STATE = 5
 DELETE_TASK_SUCCESS_STATE = 6
 RANDOM_TASK_STATE = 7
-
+IMPORT_STATE = 8
@@ -0,0 +1,70 @@
+import datetime
+import io
+import re
+
+from dateutil.tz import gettz
+
+
+# Максимальная длина строки iCalendar в байтах без CRLF
+ICS_LINE_LIMIT = 75
+ICS_DATE_TIME_FORMAT = '%Y%m%dT%H%M%SZ'
+ICS_DATE_FORMAT = '%Y%m%d'
+ICS_ESCAPES = {'\\': '\\\\', ';': '\\;', ',': '\\,', '\n': '\\n'}
+
+
+def _escape(value):
+    return re.sub(r'[\\;,\n]', lambda match: ICS_ESCAPES[match.group()], value.replace('\r', ''))
+
+
+def _fold(line):
+    # Длинные строки переносятся с пробелом в начале продолжения, не разрывая символы UTF-8
+    data = line.encode()
+    parts = []
+    limit = ICS_LINE_LIMIT
+    while len(data) > limit:
+        cut = limit
+        while data[cut] & 0xC0 == 0x80:
+            cut -= 1
+        parts.append(data[:cut])
+        data = data[cut:]
+        limit = ICS_LINE_LIMIT - 1
+    parts.append(data)
+    return b'\r\n '.join(parts) + b'\r\n'
+
+
+def _format_time(task, timestamp, tz):
+    if task.all_day:
+        # Время событий на весь день хранится как полночь в зоне пользователя
+        return 'DATE', datetime.datetime.fromtimestamp(timestamp, tz).strftime(ICS_DATE_FORMAT)
+    return 'DATE-TIME', datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime(ICS_DATE_TIME_FORMAT)
+
+
+def iter_ics(tasks, tz_name):
+    # Строки календаря в байтах, задачи читаются по одной
+    tz = gettz(tz_name)
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime(ICS_DATE_TIME_FORMAT)
+    yield _fold('BEGIN:VCALENDAR')
+    yield _fold('VERSION:2.0')
+    yield _fold('PRODID:-//calendar_telegram_bot//RU')
+    for task in tasks:
+        yield _fold('BEGIN:VEVENT')
+        yield _fold(f'UID:{task.id}')
+        yield _fold(f'DTSTAMP:{stamp}')
+        for name, timestamp in (('DTSTART', task.start), ('DTEND', task.end)):
+            value_type, value = _format_time(task, timestamp, tz)
+            yield _fold(f'{name};VALUE={value_type}:{value}' if value_type == 'DATE' else f'{name}:{value}')
+        yield _fold(f'SUMMARY:{_escape(task.summary)}')
+        yield _fold('END:VEVENT')
+    yield _fold('END:VCALENDAR')
+
+
+def make_ics_file(name, tasks, tz_name):
+    # Файл .ics для отправки в Telegram формируется целиком в потоке обработчика: синхронизация с Google
+    # не выполняется в потоке отправки сообщений, а повторная отправка после перемотки читает те же байты
+    document = io.BytesIO(b''.join(iter_ics(tasks, tz_name)))
+    document.name = name
+    return document
+
+
+def get_file_name(min_date, max_date):
+    return f'tasks_{min_date.strftime("%Y%m%d")}_{max_date.strftime("%Y%m%d")}.ics'
@@ -0,0 +1,166 @@
+import datetime
+import logging
+import re
+
+from dateutil.tz import gettz
+from googleapiclient.errors import HttpError
+
+import taskutils
+from event_store import EventStore
+
+
+logger = logging.getLogger(__name__)
+
+# Строка списка задач: дд.мм[.гггг] ЧЧ:ММ название
+LINE_PATTERN = re.compile(r'^\s*(\d{1,2})\.(\d{1,2})(?:\.(\d{4}))?\s+(\d{1,2}):(\d{2})\s+(.+?)\s*$')
+ICS_DATE_TIME_FORMAT = '%Y%m%dT%H%M%S'
+ICS_DATE_FORMAT = '%Y%m%d'
+ICS_ESCAPES = {'\\n': '\n', '\\N': '\n', '\\,': ',', '\\;': ';', '\\\\': '\\'}
+
+
+def parse_text(lines, tz_name, today):
+    # Элементы (номер строки, название, тело события или None, ошибка)
+    tz = gettz(tz_name)
+    for line_no, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        match = LINE_PATTERN.match(line)
+        if match is None:
+            yield line_no, line.strip(), None, 'неверный формат'
+            continue
+        day, month, year, hour, minute, summary = match.groups()
+        try:
+            dt = datetime.datetime(int(year or today.year), int(month), int(day), int(hour), int(minute))
+            if year is None and dt.date() < today:
+                # Год не указан, дата уже прошла - задача на следующий год
+                dt = dt.replace(year=today.year + 1)
+        except ValueError:
+            yield line_no, summary, None, 'неверная дата'
+            continue
+        start = dt.replace(tzinfo=tz)
+        yield line_no, summary, taskutils.make_event(summary, start, start + taskutils.TASK_DURATION, tz_name), None
+
+
+def _unfold(lines):
+    # Строки iCalendar, начинающиеся с пробела или табуляции, продолжают предыдущую
+    current = None
+    current_no = 0
+    for line_no, line in enumerate(lines, 1):
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield current_no, current
+        current, current_no = line, line_no
+    if current is not None:
+        yield current_no, current
+
+
+def _parse_property(line):
+    head, _, value = line.partition(':')
+    name, *params = head.split(';')
+    params = dict(param.partition('=')[::2] for param in params)
+    return name.upper(), {key.upper(): value.strip('"') for key, value in params.items()}, value
+
+
+def _unescape(value):
+    return re.sub(r'\\[nN,;\\]', lambda match: ICS_ESCAPES[match.group()], value)
+
+
+def _parse_ics_time(params, value, tz_name):
+    if params.get('VALUE') == 'DATE' or len(value) == 8:
+        return datetime.datetime.strptime(value, ICS_DATE_FORMAT).date(), None
+    if value.endswith('Z'):
+        dt = datetime.datetime.strptime(value[:-1], ICS_DATE_TIME_FORMAT)
+        return dt.replace(tzinfo=datetime.timezone.utc), 'UTC'
+    # Время без зоны считается временем пользователя
+    tzid = params.get('TZID')
+    if not tzid or gettz(tzid) is None:
+        tzid = tz_name
+    return datetime.datetime.strptime(value, ICS_DATE_TIME_FORMAT).replace(tzinfo=gettz(tzid)), tzid
+
+
+def _make_ics_item(line_no, properties, tz_name):
+    summary = _unescape(properties.get('SUMMARY', ({}, ''))[1])
+    if 'DTSTART' not in properties:
+        return line_no, summary, None, 'нет времени начала'
+    try:
+        start, start_tz_name = _parse_ics_time(*properties['DTSTART'], tz_name)
+        end = _parse_ics_time(*properties['DTEND'], tz_name)[0] if 'DTEND' in properties else None
+    except ValueError:
+        return line_no, summary, None, 'неверная дата'
+    if end is None:
+        end = start + (taskutils.TASK_DURATION if start_tz_name else datetime.timedelta(days=1))
+    event = taskutils.make_event(summary, start, end, start_tz_name)
+    if 'RRULE' in properties:
+        event['recurrence'] = ['RRULE:' + properties['RRULE'][1]]
+    return line_no, summary, event, None
+
+
+def parse_ics(lines, tz_name):
+    # Потоковый разбор VEVENT: вложенные компоненты (VALARM) пропускаются
+    properties = None
+    line_no = 0
+    depth = 0
+    for number, line in _unfold(lines):
+        name, params, value = _parse_property(line)
+        if name == 'BEGIN':
+            if properties is not None:
+                depth += 1
+            elif value.upper() == 'VEVENT':
+                properties = {}
+                line_no = number
+        elif name == 'END' and properties is not None:
+            if depth:
+                depth -= 1
+            elif value.upper() == 'VEVENT':
+                yield _make_ics_item(line_no, properties, tz_name)
+                properties = None
+        elif properties is not None and not depth:
+            properties[name] = (params, value)
+
+
+def _get_error_text(exception):
+    if isinstance(exception, HttpError):
+        return f'ошибка Google {exception.resp.status}'
+    return 'ошибка Google'
+
+
+def import_tasks(user, items):
+    # События отправляются batch-запросами по мере разбора, отчет - в порядке строк
+    report = []
+    imported = 0
+    pending = []
+    pending_events = 0
+    for item in items:
+        pending.append(item)
+        if item[2] is not None:
+            pending_events += 1
+        if pending_events >= EventStore.BATCH_SIZE:
+            imported += _import_pending(user, pending, report)
+            pending = []
+            pending_events = 0
+    if pending:
+        imported += _import_pending(user, pending, report)
+    return imported, report
+
+
+def _import_pending(user, items, report):
+    events = [event for _, _, event, _ in items if event is not None]
+    try:
+        results = iter(user.add_tasks(events) if events else ())
+    except Exception as e:
+        logger.exception('Failed to import tasks of user %s', user.user_id)
+        results = iter([e] * len(events))
+    imported = 0
+    for line_no, summary, event, error in items:
+        if event is not None:
+            exception = next(results)
+            error = _get_error_text(exception) if exception is not None else None
+        if error is None:
+            imported += 1
+            report.append(f'{line_no}. ✅ {summary}')
+        else:
+            report.append(f'{line_no}. ❌ {summary} - {error}')
+    return imported
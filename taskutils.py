@@ -1,25 +1,85 @@
 import datetime
+import itertools
+import time
+import uuid
 import dateutil.parser
 from dateutil.tz import gettz
 
 
-def get_task_start_time(task):
-    return dateutil.parser.parse(task['start'].get('dateTime', task['start'].get('date')))
+# Максимальная длина сообщения Telegram
+MESSAGE_LIMIT = 4096
+# Продолжительность задачи, если время окончания не указано
+TASK_DURATION = datetime.timedelta(hours=1)
+
+
+class Task:
+    # Компактное представление события Google Календаря, время начала и конца - UTC timestamp
+    __slots__ = ('id', 'summary', 'calendar_id', 'all_day', 'start', 'end')
+
+    def __init__(self, task_id, summary, calendar_id, all_day, start, end):
+        self.id = task_id
+        self.summary = summary
+        self.calendar_id = calendar_id
+        self.all_day = all_day
+        self.start = start
+        self.end = end
+
+    @classmethod
+    def from_event(cls, event, calendar_id, tz=None):
+        return cls(event['id'],
+                   event.get('summary', ''),
+                   calendar_id,
+                   'dateTime' not in event['start'],
+                   parse_event_time(event['start'], tz),
+                   parse_event_time(event['end'], tz))
+
+
+def make_event(summary, start, end, tz_name):
+    # Тело события Google Календаря; зона времени нужна Google для повторяющихся событий.
+    # id задается клиентом: повтор вставки после сбоя получает 409, а не создает второе событие.
+    # Google допускает в id символы base32hex (0-9, a-v), шестнадцатеричный uuid им соответствует.
+    event = {'id': uuid.uuid4().hex, 'summary': summary}
+    if isinstance(start, datetime.datetime):
+        if not isinstance(end, datetime.datetime):
+            # Начало и конец события должны быть одного типа: конец-дата означает полночь
+            end = max(datetime.datetime.combine(end, datetime.time(), start.tzinfo), start + TASK_DURATION)
+        event['start'] = {'dateTime': start.isoformat(), 'timeZone': tz_name}
+        event['end'] = {'dateTime': end.isoformat(), 'timeZone': tz_name}
+    else:
+        if isinstance(end, datetime.datetime):
+            # Событие на весь день заканчивается не раньше следующего дня
+            end = max(end.date(), start + datetime.timedelta(days=1))
+        event['start'] = {'date': start.isoformat()}
+        event['end'] = {'date': end.isoformat()}
+    return event
+
+
+def parse_event_time(event_time, tz=None):
+    if 'date' in event_time and 'dateTime' not in event_time:
+        # Событие на весь день начинается в полночь в зоне tz, без зоны - в локальной зоне сервера
+        return datetime.datetime.fromisoformat(event_time['date']).replace(tzinfo=tz).timestamp()
+
+    value = event_time['dateTime']
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    try:
+        dt = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        dt = dateutil.parser.parse(value)
+    return dt.timestamp()
 
 
 def get_task_start_time_utc(task):
-    dt_with_tz = get_task_start_time(task)
-    return dt_with_tz.astimezone(datetime.timezone.utc)
+    return datetime.datetime.fromtimestamp(task.start, datetime.timezone.utc)
 
 
 def get_task_start_time_tz(task, tz_name):
-    dt_with_tz = get_task_start_time(task)
-    return dt_with_tz.astimezone(gettz(tz_name))
+    return datetime.datetime.fromtimestamp(task.start, gettz(tz_name))
 
 
 def task_to_string(task, tz_name, with_date=False):
     dt_format = '%d.%m.%Y %H:%M' if with_date else '%H:%M'
-    return '{0} {1}'.format(get_task_start_time_tz(task, tz_name).strftime(dt_format), task['summary'])
+    return '{0} {1}'.format(get_task_start_time_tz(task, tz_name).strftime(dt_format), task.summary)
 
 
 def tasks_to_string(tasks, tz_name):
@@ -27,12 +87,46 @@ def tasks_to_string(tasks, tz_name):
         return 'Список пуст.'
 
     str_list = ['Расписание:']
-    now = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
+    now = time.time()
     for task in tasks:
-        if get_task_start_time_utc(task) < now:
+        if task.start < now:
             form = '_'
         else:
             form = '*'
         string = f' - {form}{task_to_string(task, tz_name)}{form}'
         str_list.append(string)
-    return '\n'.join(str_list)
\ No newline at end of file
+    return '\n'.join(str_list)
+
+
+def agenda_to_string(tasks, tz_name, min_date):
+    # Задачи группируются по дню начала в зоне пользователя, начавшиеся раньше - в первый день
+    if not tasks:
+        return 'Список пуст.'
+
+    str_list = ['Расписание:']
+    now = time.time()
+    days = itertools.groupby(tasks, key=lambda task: max(min_date, get_task_start_time_tz(task, tz_name).date()))
+    for day, day_tasks in days:
+        str_list.append(f'\n*{day.strftime("%d.%m.%Y")}*')
+        for task in day_tasks:
+            form = '_' if task.start < now else '*'
+            str_list.append(f' - {form}{task_to_string(task, tz_name)}{form}')
+    return '\n'.join(str_list)
+
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    # Разбиение по строкам, чтобы не разрывать разметку
+    parts = []
+    lines = []
+    length = 0
+    for line in text.split('\n'):
+        # Длинная строка обрезается, в длину части учитывается обрезанная строка
+        line = line[:limit]
+        if lines and length + len(line) + 1 > limit:
+            parts.append('\n'.join(lines))
+            lines = []
+            length = 0
+        lines.append(line)
+        length += len(line) + 1
+    parts.append('\n'.join(lines))
+    return parts
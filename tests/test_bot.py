@@ -0,0 +1,57 @@
+import pytest
+
+pytest.importorskip('telebot')
+pytest.importorskip('googleapiclient')
+pytest.importorskip('dateutil')
+pytest.importorskip('fakeredis')
+
+from fakes import install_redis, message_update, setup_environment
+
+setup_environment()
+install_redis()
+
+import telebot
+
+import bot
+
+
+class RecordingDispatcher:
+    def __init__(self):
+        self.updates = []
+
+    def submit(self, update):
+        self.updates.append(update.update_id)
+
+
+def make_update(update_id):
+    return telebot.types.Update.de_json(message_update(update_id, 1, 'text'))
+
+
+@pytest.fixture
+def dispatcher(monkeypatch):
+    dispatcher = RecordingDispatcher()
+    monkeypatch.setattr(bot, 'update_dispatcher', dispatcher)
+    monkeypatch.setattr(bot.bot, 'last_update_id', 0)
+    return dispatcher
+
+
+def test_polling_offset_advances_before_processing(monkeypatch, dispatcher):
+    batches = [[make_update(1), make_update(2)], [make_update(3)], []]
+    offsets = []
+
+    def get_updates(offset=None, timeout=None, **kwargs):
+        offsets.append(offset)
+        return batches.pop(0)
+
+    monkeypatch.setattr(bot.bot, 'get_updates', get_updates)
+    for _ in range(3):
+        bot.bot._TeleBot__retrieve_updates(timeout=0)
+    # Обновления еще не обработаны, но повторно не запрашиваются
+    assert offsets == [1, 3, 4]
+    assert dispatcher.updates == [1, 2, 3]
+
+
+def test_handler_does_not_move_offset_back(dispatcher):
+    bot.bot.process_new_updates([make_update(5)])
+    telebot.TeleBot.process_new_updates(bot.bot, [make_update(4)])
+    assert bot.bot.last_update_id == 5
@@ -0,0 +1,36 @@
+import datetime
+
+import pytest
+
+import callback_codec
+
+DT = datetime.datetime(2026, 10, 18, 9, 30)
+
+
+@pytest.mark.parametrize('action, args', [
+    ('empty', ()),
+    ('dt', (DT,)),
+    ('calendar', (DT,)),
+    ('calendar_day', (DT, True)),
+    ('calendar_month', ('prev', DT, False)),
+    ('today', (DT, False)),
+    ('tomorrow', (DT, True)),
+    ('edit', ('minute', 'next', DT)),
+    ('delete', ('abc:def_123',)),
+    ('dt', (datetime.datetime(1969, 12, 31, 23, 59),)),
+])
+def test_round_trip(action, args):
+    data = callback_codec.encode(action, *args)
+    # Ограничение Telegram на callback_data - 64 байта
+    assert len(data.encode()) <= 64
+    assert callback_codec.decode(data) == (action, args)
+
+
+def test_old_format_is_decoded():
+    assert callback_codec.decode('calendar_day:2026.10.18.09.30:True') == ('calendar_day', (DT, True))
+    assert callback_codec.decode('delete:abc:def') == ('delete', ('abc:def',))
+
+
+@pytest.mark.parametrize('data', ['', '1?', 'unknown:1'])
+def test_unknown_data(data):
+    assert callback_codec.decode(data) == (None, ())
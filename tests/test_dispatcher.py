@@ -0,0 +1,63 @@
+import threading
+import time
+
+from dispatcher import UpdateDispatcher
+
+
+def test_updates_of_one_key_are_processed_in_order():
+    processed = []
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def handler(update):
+        key, number = update
+        # Обработка с задержкой: параллельная обработка одного ключа нарушила бы порядок
+        time.sleep(0.001 * (5 - number % 5))
+        with lock:
+            processed.append(update)
+            if len(processed) == 40:
+                done.set()
+
+    dispatcher = UpdateDispatcher(handler, lambda update: update[0], workers=4, backlog=100)
+    for number in range(10):
+        for key in range(4):
+            dispatcher.submit((key, number))
+    assert done.wait(5)
+    for key in range(4):
+        assert [number for k, number in processed if k == key] == list(range(10))
+
+
+def test_different_keys_are_processed_in_parallel():
+    barrier = threading.Barrier(3, timeout=5)
+    dispatcher = UpdateDispatcher(lambda update: barrier.wait(), lambda update: update, workers=3, backlog=10)
+    for key in range(2):
+        dispatcher.submit(key)
+    # Все три участника встречаются только если два обновления обрабатываются одновременно
+    barrier.wait()
+
+
+def test_try_submit_rejects_when_backlog_is_full():
+    release = threading.Event()
+    dispatcher = UpdateDispatcher(lambda update: release.wait(5), lambda update: update, workers=1, backlog=2)
+    assert dispatcher.try_submit(1)
+    assert dispatcher.try_submit(2)
+    assert not dispatcher.try_submit(3)
+    assert dispatcher.depth() == 2
+    release.set()
+
+
+def test_handler_error_does_not_stop_the_queue():
+    processed = []
+    done = threading.Event()
+
+    def handler(update):
+        if update == 1:
+            raise ValueError(update)
+        processed.append(update)
+        done.set()
+
+    dispatcher = UpdateDispatcher(handler, lambda update: 'user', workers=1, backlog=10)
+    dispatcher.submit(1)
+    dispatcher.submit(2)
+    assert done.wait(5)
+    assert processed == [2]
@@ -0,0 +1,109 @@
+import datetime
+
+import pytest
+
+pytest.importorskip('dateutil')
+pytest.importorskip('googleapiclient')
+pytest.importorskip('fakeredis')
+
+from fakes import FakeCalendarService, install_redis, make_http_error, setup_environment
+
+setup_environment()
+install_redis()
+
+import governor
+from user_data import UserData, redis_db
+
+
+@pytest.fixture
+def user(monkeypatch):
+    redis_db.flushdb()
+    # Повторы batch-запроса выполняются без паузы
+    monkeypatch.setattr(governor, 'backoff', lambda attempt: 0)
+    user = UserData(1)
+    user.service = FakeCalendarService(calendars=2, events_per_calendar=5)
+    return user
+
+
+def get_task_ids(user):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return {task.id for task in user.events.get_range(now - datetime.timedelta(days=30),
+                                                       now + datetime.timedelta(days=30))}
+
+
+def get_event_ids(service):
+    return {event_id for calendar in service._calendars.values()
+            for event_id, event in calendar.events.items() if event['status'] != 'cancelled'}
+
+
+def test_cancelled_events_are_removed(user):
+    service = user.service
+    assert get_task_ids(user) == get_event_ids(service)
+    calendar_id = next(iter(service._calendars))
+    event_id = next(iter(service._calendars[calendar_id].events))
+    service.events().delete(calendarId=calendar_id, eventId=event_id).execute()
+
+    user.events.sync(force=True)
+    assert event_id not in get_task_ids(user)
+    assert get_task_ids(user) == get_event_ids(service)
+    # Синхронизация по syncToken получила только удаление, индекс событий в Redis обновлен
+    assert redis_db.hget(user._event_index_key, event_id) is None
+
+
+def test_expired_sync_token_restarts_full_sync(user, monkeypatch):
+    service = user.service
+    get_task_ids(user)
+    calendar_id = next(iter(service._calendars))
+    event_id = next(iter(service._calendars[calendar_id].events))
+    service.events().delete(calendarId=calendar_id, eventId=event_id).execute()
+
+    list_events = service._events_list
+    calls = []
+
+    def events_list(headers, syncToken=None, **params):
+        calls.append(syncToken)
+        if syncToken is not None and params['calendarId'] == calendar_id:
+            raise make_http_error(410, 'fullSyncRequired')
+        return list_events(headers, syncToken=syncToken, **params)
+
+    monkeypatch.setattr(service, '_events_list', events_list)
+    user.events.sync(force=True)
+    # Календарь с устаревшим токеном загружен заново, остальные - по syncToken
+    assert calls.count(None) == 1
+    assert get_task_ids(user) == get_event_ids(service)
+
+
+def test_missing_batch_response_is_retried(user, monkeypatch):
+    service = user.service
+    new_batch = service.new_batch_http_request
+    dropped = []
+
+    def new_batch_http_request(callback=None):
+        def drop_first(request_id, response, exception):
+            # Ответ первого календаря в первом batch-запросе отсутствует
+            if not dropped:
+                dropped.append(request_id)
+                return
+            callback(request_id, response, exception)
+        return new_batch(callback=drop_first)
+
+    monkeypatch.setattr(service, 'new_batch_http_request', new_batch_http_request)
+    assert get_task_ids(user) == get_event_ids(service)
+    assert len(dropped) == 1
+    assert service.counter.calls['calendar.events.list'] == 3
+
+
+def test_deleted_calendar_is_dropped(user):
+    service = user.service
+    get_task_ids(user)
+    calendar_id, calendar = next(iter(service._calendars.items()))
+    # Календарь удален после того, как список календарей был закэширован
+    del service._calendars[calendar_id]
+
+    user.events.sync(force=True)
+    assert get_task_ids(user) == get_event_ids(service)
+    assert not get_task_ids(user) & set(calendar.events)
+    # Кэш списка календарей сброшен, следующая синхронизация получит актуальный список
+    assert user._calendars is None
+    user.events.sync(force=True)
+    assert [item['id'] for item in user.get_calendars()] == list(service._calendars)
@@ -0,0 +1,90 @@
+import time
+
+import pytest
+
+pytest.importorskip('googleapiclient')
+
+from fakes import make_http_error
+from googleapiclient.errors import HttpError
+
+import governor
+from ratelimit import TokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Ожидание лимита сдвигает время вместо сна
+    now = [1000.0]
+
+    def sleep(seconds):
+        now[0] += seconds
+
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(time, 'sleep', sleep)
+    return now
+
+
+def test_background_batch_keeps_global_reserve(clock, monkeypatch):
+    global_bucket = TokenBucket(rate=10, capacity=100)
+    monkeypatch.setattr(governor, '_global_bucket', global_bucket)
+    reserve = global_bucket.capacity * governor.GOOGLE_INTERACTIVE_RESERVE
+    start = clock[0]
+    with governor.background():
+        governor._acquire(TokenBucket(rate=1000, capacity=1000), 200)
+    # Batch списан полностью, но интерактивный запрос получает резерв без ожидания
+    assert clock[0] - start >= (200 - global_bucket.capacity + reserve) / global_bucket.rate
+    assert global_bucket.delay(reserve) == 0
+
+
+@pytest.mark.parametrize('error, retryable', [
+    (make_http_error(429, 'rateLimitExceeded'), True),
+    (make_http_error(503, 'backendError'), True),
+    (make_http_error(403, 'userRateLimitExceeded'), True),
+    (make_http_error(403, 'forbidden'), False),
+    (make_http_error(404, 'notFound'), False),
+    (make_http_error(410, 'fullSyncRequired'), False),
+    (ConnectionResetError(), True),
+    (ValueError(), False),
+])
+def test_is_retryable(error, retryable):
+    assert governor.is_retryable(error) == retryable
+
+
+class Request:
+    methodId = 'calendar.events.list'
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def execute(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+
+def test_execute_retries_temporary_errors(clock):
+    request = Request([make_http_error(503, 'backendError')] * governor.GOOGLE_MAX_RETRIES)
+    assert governor.execute(request, governor.user_bucket()) == 'ok'
+    assert request.calls == governor.GOOGLE_MAX_RETRIES + 1
+
+
+def test_execute_stops_after_max_retries(clock):
+    request = Request([make_http_error(503, 'backendError')] * (governor.GOOGLE_MAX_RETRIES + 1))
+    with pytest.raises(HttpError):
+        governor.execute(request, governor.user_bucket())
+    assert request.calls == governor.GOOGLE_MAX_RETRIES + 1
+
+
+def test_execute_does_not_retry_permanent_errors(clock):
+    request = Request([make_http_error(404, 'notFound')])
+    with pytest.raises(HttpError):
+        governor.execute(request, governor.user_bucket())
+    assert request.calls == 1
+
+
+def test_interactive_backoff_is_shorter(clock):
+    assert all(governor.backoff(10) <= governor.INTERACTIVE_BACKOFF_MAX for _ in range(20))
+    with governor.background():
+        assert max(governor.backoff(10) for _ in range(20)) > governor.INTERACTIVE_BACKOFF_MAX
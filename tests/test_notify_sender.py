@@ -0,0 +1,120 @@
+from concurrent.futures import Future
+import time
+
+import pytest
+
+pytest.importorskip('dateutil')
+pytest.importorskip('googleapiclient')
+pytest.importorskip('fakeredis')
+
+from fakes import AllShards, install_redis, setup_environment
+
+setup_environment()
+install_redis()
+
+import notify_sender
+from notify_sender import NotifySender
+from taskutils import Task
+from user_data import redis_db
+
+
+class User:
+    def __init__(self, user_id, tasks):
+        self.user_id = user_id
+        self.tz_name = 'UTC'
+        self.tasks = tasks
+
+    def get_tasks(self, min_date_time, max_date_time):
+        return list(self.tasks)
+
+
+class Sender:
+    # Отправитель, завершающий Future по команде теста
+    def __init__(self):
+        self.sent = []
+        self.texts = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        future = Future()
+        self.sent.append((chat_id, future))
+        self.texts.append(text)
+        return future
+
+
+def make_task(task_id, start=None):
+    start = time.time() - 1 if start is None else start
+    return Task(task_id, task_id, 'calendar', False, start, start + 3600)
+
+
+@pytest.fixture
+def sender():
+    redis_db.flushdb()
+    return Sender()
+
+
+def make_notifier(sender):
+    return NotifySender(sender, users=None, leases=AllShards())
+
+
+def test_reminder_is_sent_once(sender):
+    notifier = make_notifier(sender)
+    user = User(1, [make_task('task')])
+    notifier._refresh_user(user)
+    notifier._send_due_reminders()
+    assert [chat_id for chat_id, _ in sender.sent] == [1]
+    # Обновление во время отправки не ставит напоминание повторно
+    notifier._refresh_user(user)
+    notifier._send_due_reminders()
+    sender.sent[0][1].set_result(None)
+    notifier._refresh_user(user)
+    notifier._send_due_reminders()
+    assert len(sender.sent) == 1
+    assert notifier.pending_reminders() == 0
+
+
+def test_reminder_is_sent_by_one_replica(sender):
+    user = User(1, [make_task('task')])
+    notifiers = [make_notifier(sender), make_notifier(sender)]
+    for notifier in notifiers:
+        notifier._refresh_user(user)
+        notifier._send_due_reminders()
+    assert len(sender.sent) == 1
+    sender.sent[0][1].set_result(None)
+    key = f'reminder_1_task_{int(user.tasks[0].start)}'
+    assert redis_db.get(key) == b'sent'
+    # Реплика, не получившая напоминание, проверяет его после окончания захвата и не отправляет повторно
+    notifiers[1]._reminders = [(0,) + entry[1:] for entry in notifiers[1]._reminders]
+    notifiers[1]._send_due_reminders()
+    assert len(sender.sent) == 1
+    assert notifiers[1].pending_reminders() == 0
+
+
+def test_refresh_invalidates_removed_tasks(sender):
+    notifier = make_notifier(sender)
+    user = User(1, [make_task('removed'), make_task('kept')])
+    notifier._refresh_user(user)
+    # Задача удалена до отправки напоминания - напоминание предыдущего поколения не отправляется
+    user.tasks = user.tasks[1:]
+    notifier._refresh_user(user)
+    notifier._send_due_reminders()
+    assert len(sender.texts) == 1 and 'kept' in sender.texts[0]
+    assert notifier.pending_reminders() == 0
+
+
+def test_failed_reminder_is_retried(sender, monkeypatch):
+    monkeypatch.setattr(notify_sender, 'REMINDER_RETRY_INTERVAL', 0)
+    notifier = make_notifier(sender)
+    task = make_task('task')
+    notifier._refresh_user(User(1, [task]))
+    notifier._send_due_reminders()
+    sender.sent[0][1].set_exception(OSError('network error'))
+    # Ключ освобожден, напоминание вернулось в очередь
+    key = f'reminder_1_task_{int(task.start)}'
+    assert redis_db.get(key) is None
+    assert notifier.pending_reminders() == 1
+
+    notifier._send_due_reminders()
+    assert len(sender.sent) == 2
+    sender.sent[1][1].set_result(None)
+    assert redis_db.get(key) == b'sent'
+    assert notifier.pending_reminders() == 0
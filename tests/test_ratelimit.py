@@ -0,0 +1,42 @@
+import time
+
+import pytest
+
+from ratelimit import TokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_burst_up_to_capacity(clock):
+    bucket = TokenBucket(rate=1, capacity=3)
+    assert [bucket.try_take() for _ in range(3)] == [0, 0, 0]
+    assert bucket.try_take() == pytest.approx(1)
+
+
+def test_refill_with_time(clock):
+    bucket = TokenBucket(rate=2, capacity=2)
+    bucket.try_take(2)
+    assert bucket.delay() == pytest.approx(0.5)
+    clock[0] += 0.5
+    assert bucket.delay() == 0
+    assert bucket.try_take() == 0
+
+
+def test_request_above_capacity_waits_for_full_bucket_and_goes_into_debt(clock):
+    bucket = TokenBucket(rate=1, capacity=2)
+    bucket.try_take(1)
+    assert bucket.try_take(5) == pytest.approx(1)
+    clock[0] += 1
+    assert bucket.try_take(5) == 0
+    assert bucket.delay() == pytest.approx(4)
+
+
+def test_delay_does_not_take_tokens(clock):
+    bucket = TokenBucket(rate=1, capacity=1)
+    assert bucket.delay() == 0
+    assert bucket.try_take() == 0
@@ -0,0 +1,89 @@
+import io
+import threading
+import time
+
+import pytest
+
+from fakes import setup_environment
+
+setup_environment()
+
+import send_queue
+from send_queue import SendQueue, INTERACTIVE, REMINDER
+
+
+class TooManyRequests(Exception):
+    def __init__(self, retry_after):
+        Exception.__init__(self, 'Too Many Requests')
+        self.result = self
+        self.status_code = 429
+        self._retry_after = retry_after
+
+    def json(self):
+        return {'parameters': {'retry_after': self._retry_after}}
+
+
+class Bot:
+    def __init__(self):
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id, text):
+        # Задержка отправки: параллельная отправка сообщений одного чата нарушила бы порядок
+        time.sleep(0.001 * (text % 3))
+        with self._lock:
+            self.sent.append((chat_id, text))
+        return text
+
+
+def wait_all(futures):
+    return [future.result(timeout=5) for future in futures]
+
+
+def test_interactive_messages_are_sent_before_reminders(monkeypatch):
+    monkeypatch.setattr(send_queue, 'SEND_WORKERS', 1)
+    bot = Bot()
+    queue = SendQueue(bot)
+    futures = [queue.put(REMINDER, chat_id, 'send_message', chat_id, chat_id) for chat_id in range(3)]
+    futures += [queue.put(INTERACTIVE, chat_id, 'send_message', chat_id, chat_id) for chat_id in range(3, 6)]
+    queue.start()
+    wait_all(futures)
+    assert [chat_id for chat_id, _ in bot.sent] == [3, 4, 5, 0, 1, 2]
+    assert queue.depth() == 0
+
+
+def test_messages_of_one_chat_are_sent_in_order():
+    bot = Bot()
+    queue = SendQueue(bot)
+    queue.start()
+    futures = [queue.client(INTERACTIVE).send_message(chat_id, text) for text in range(20) for chat_id in range(4)]
+    assert wait_all(futures) == [text for text in range(20) for _ in range(4)]
+    for chat_id in range(4):
+        assert [text for chat, text in bot.sent if chat == chat_id] == list(range(20))
+
+
+def test_retry_after_delays_only_its_chat():
+    calls = []
+
+    class LimitedBot(Bot):
+        def send_document(self, chat_id, document):
+            calls.append(document.read())
+            if len(calls) == 1:
+                raise TooManyRequests(0.2)
+            with self._lock:
+                self.sent.append((chat_id, 'document'))
+
+    bot = LimitedBot()
+    queue = SendQueue(bot)
+    queue.start()
+    client = queue.client(INTERACTIVE)
+    document = client.send_document(1, io.BytesIO(b'tasks'))
+    after_document = client.send_message(1, 0)
+    other_chat = client.send_message(2, 0)
+    other_chat.result(timeout=5)
+    # Другой чат не ждет паузы, назначенной Telegram
+    assert bot.sent == [(2, 0)]
+    wait_all([document, after_document])
+    # Файл перечитан с начала, следующее сообщение чата отправлено после повтора
+    assert calls == [b'tasks', b'tasks']
+    assert bot.sent == [(2, 0), (1, 'document'), (1, 0)]
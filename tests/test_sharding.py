@@ -0,0 +1,46 @@
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+# Скрипты Lua в fakeredis выполняются через lupa
+pytest.importorskip('lupa')
+
+import sharding
+
+
+@pytest.fixture
+def redis_db():
+    return fakeredis.FakeStrictRedis()
+
+
+def owned(leases):
+    return {shard for shard in range(sharding.SHARD_COUNT) if leases.owns(shard)}
+
+
+def test_single_node_takes_all_shards(redis_db):
+    leases = sharding.ShardLeases(redis_db)
+    leases.heartbeat()
+    assert owned(leases) == set(range(sharding.SHARD_COUNT))
+
+
+def test_shards_are_split_between_nodes_without_overlap(redis_db):
+    first = sharding.ShardLeases(redis_db)
+    second = sharding.ShardLeases(redis_db)
+    first.heartbeat()
+    second.heartbeat()
+    # Первая реплика отдает лишние шарды, вторая захватывает освободившиеся
+    first.heartbeat()
+    second.heartbeat()
+    assert not owned(first) & owned(second)
+    assert owned(first) | owned(second) == set(range(sharding.SHARD_COUNT))
+    assert abs(len(owned(first)) - len(owned(second))) <= 1
+
+
+def test_change_callback_reports_acquired_and_lost_shards(redis_db):
+    changes = []
+    first = sharding.ShardLeases(redis_db, on_change=lambda acquired, lost: changes.append((acquired, lost)))
+    second = sharding.ShardLeases(redis_db)
+    first.heartbeat()
+    second.heartbeat()
+    first.heartbeat()
+    assert changes[0] == (set(range(sharding.SHARD_COUNT)), set())
+    assert changes[1][0] == set() and changes[1][1]
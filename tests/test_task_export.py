@@ -0,0 +1,58 @@
+import pytest
+
+pytest.importorskip('dateutil')
+
+from task_export import make_ics_file, iter_ics, ICS_LINE_LIMIT
+from taskutils import Task
+
+
+def make_task(summary, all_day=False):
+    # 18.10.2026 09:30 UTC
+    start = 1792315800.0
+    return Task('task1', summary, 'calendar', all_day, start, start + 3600)
+
+
+def read_lines(tasks, tz_name='UTC'):
+    return b''.join(iter_ics(tasks, tz_name)).split(b'\r\n')
+
+
+def test_event_lines():
+    lines = read_lines([make_task('Встреча, важная; \\ срочно')])
+    assert lines[0] == b'BEGIN:VCALENDAR'
+    assert b'DTSTART:20261018T093000Z' in lines
+    assert b'DTEND:20261018T103000Z' in lines
+    assert 'SUMMARY:Встреча\\, важная\\; \\\\ срочно'.encode() in lines
+    assert lines[-2:] == [b'END:VCALENDAR', b'']
+
+
+def test_all_day_dates_use_user_time_zone():
+    # Полночь 18.10.2026 по Москве - 17.10.2026 21:00 UTC
+    start = 1792270800.0
+    lines = read_lines([Task('task1', 'День', 'calendar', True, start, start + 24 * 3600)], 'Europe/Moscow')
+    assert b'DTSTART;VALUE=DATE:20261018' in lines
+    assert b'DTEND;VALUE=DATE:20261019' in lines
+
+
+def test_long_lines_are_folded_without_splitting_characters():
+    summary = 'Задача ' * 40
+    lines = read_lines([make_task(summary)])
+    assert all(len(line) <= ICS_LINE_LIMIT for line in lines)
+    start = next(i for i, line in enumerate(lines) if line.startswith(b'SUMMARY:'))
+    folded = lines[start]
+    for line in lines[start + 1:]:
+        if not line.startswith(b' '):
+            break
+        folded += line[1:]
+    # Каждая часть - корректный UTF-8, склеенная строка совпадает с исходной
+    assert folded.decode() == 'SUMMARY:' + summary
+
+
+def test_file_has_name_and_rewinds():
+    tasks = [make_task(f'task {i}') for i in range(100)]
+    # Итератор задач читается один раз, перемотка повторяет сформированный документ
+    document = make_ics_file('tasks.ics', iter(tasks), 'UTC')
+    assert document.name == 'tasks.ics'
+    data = document.read()
+    assert data.count(b'BEGIN:VEVENT') == 100
+    document.seek(0)
+    assert document.read() == data
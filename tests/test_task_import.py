@@ -0,0 +1,65 @@
+import datetime
+
+import pytest
+
+pytest.importorskip('dateutil')
+pytest.importorskip('googleapiclient')
+
+import task_import
+
+TODAY = datetime.date(2026, 10, 18)
+
+
+def test_parse_text():
+    items = list(task_import.parse_text(['18.10 09:30 Встреча', '', '01.01.2027 10:00 Новый год',
+                                         'без времени', '31.02 10:00 Нет такой даты'], 'Europe/Moscow', TODAY))
+    assert [(line_no, summary, error) for line_no, summary, _, error in items] == [
+        (1, 'Встреча', None),
+        (3, 'Новый год', None),
+        (4, 'без времени', 'неверный формат'),
+        (5, 'Нет такой даты', 'неверная дата'),
+    ]
+    event = items[0][2]
+    assert event['start'] == {'dateTime': '2026-10-18T09:30:00+03:00', 'timeZone': 'Europe/Moscow'}
+    assert event['end']['dateTime'] == '2026-10-18T10:30:00+03:00'
+
+
+def test_parse_text_past_date_without_year_moves_to_next_year():
+    (_, _, event, _), = task_import.parse_text(['01.01 10:00 Праздник'], 'UTC', TODAY)
+    assert event['start']['dateTime'].startswith('2027-01-01')
+
+
+ICS = '''BEGIN:VCALENDAR
+BEGIN:VEVENT
+SUMMARY:Длинное\\, название
+ продолжение
+DTSTART;TZID=Europe/Moscow:20261020T100000
+DTEND;TZID=Europe/Moscow:20261020T113000
+RRULE:FREQ=WEEKLY
+BEGIN:VALARM
+SUMMARY:Напоминание
+END:VALARM
+END:VEVENT
+BEGIN:VEVENT
+SUMMARY:Весь день
+DTSTART;VALUE=DATE:20261021
+END:VEVENT
+BEGIN:VEVENT
+SUMMARY:Без начала
+END:VEVENT
+END:VCALENDAR
+'''
+
+
+def test_parse_ics():
+    items = list(task_import.parse_ics(ICS.splitlines(True), 'UTC'))
+    assert [(summary, error) for _, summary, _, error in items] == [
+        ('Длинное, названиепродолжение', None),
+        ('Весь день', None),
+        ('Без начала', 'нет времени начала'),
+    ]
+    event = items[0][2]
+    assert event['start'] == {'dateTime': '2026-10-20T10:00:00+03:00', 'timeZone': 'Europe/Moscow'}
+    assert event['recurrence'] == ['RRULE:FREQ=WEEKLY']
+    assert items[1][2]['start'] == {'date': '2026-10-21'}
+    assert items[1][2]['end'] == {'date': '2026-10-22'}
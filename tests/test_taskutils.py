@@ -0,0 +1,45 @@
+import datetime
+
+import pytest
+
+pytest.importorskip('dateutil')
+
+from taskutils import TASK_DURATION, make_event, parse_event_time, split_message
+
+
+def test_split_message_keeps_lines():
+    text = '\n'.join(f'line {i}' for i in range(100))
+    parts = split_message(text, limit=50)
+    assert all(len(part) <= 50 for part in parts)
+    assert '\n'.join(parts) == text
+
+
+def test_split_message_truncates_long_line():
+    parts = split_message('short\n' + 'x' * 100 + '\nend\nok', limit=20)
+    assert parts == ['short', 'x' * 20, 'end\nok']
+
+
+def test_all_day_event_starts_at_midnight_in_time_zone():
+    tz = datetime.timezone(datetime.timedelta(hours=3))
+    assert parse_event_time({'date': '2026-10-18'}, tz) == 1792270800.0
+
+
+def test_make_event_ids_are_unique_base32hex():
+    start = datetime.datetime(2026, 10, 18, 9, 30, tzinfo=datetime.timezone.utc)
+    first = make_event('a', start, start + TASK_DURATION, 'UTC')
+    second = make_event('a', start, start + TASK_DURATION, 'UTC')
+    assert first['id'] != second['id']
+    assert set(first['id']) <= set('0123456789abcdefghijklmnopqrstuv')
+
+
+def test_make_event_end_matches_start_kind():
+    start = datetime.datetime(2026, 10, 18, 9, 30, tzinfo=datetime.timezone.utc)
+    event = make_event('a', start, datetime.date(2026, 10, 19), 'UTC')
+    assert event['end'] == {'dateTime': '2026-10-19T00:00:00+00:00', 'timeZone': 'UTC'}
+    # Конец-дата раньше начала заменяется продолжительностью по умолчанию
+    event = make_event('a', start, datetime.date(2026, 10, 18), 'UTC')
+    assert event['end']['dateTime'] == '2026-10-18T10:30:00+00:00'
+
+    event = make_event('a', datetime.date(2026, 10, 18), start, None)
+    assert event['start'] == {'date': '2026-10-18'}
+    assert event['end'] == {'date': '2026-10-19'}
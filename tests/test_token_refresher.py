@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+pytest.importorskip('dateutil')
+pytest.importorskip('googleapiclient')
+pytest.importorskip('fakeredis')
+
+from fakes import install_redis, setup_environment
+
+setup_environment()
+install_redis()
+
+import google.oauth2.credentials
+
+import transport
+import user_data
+from user_data import redis_db
+
+
+class Response:
+    status_code = 200
+    headers = {}
+    content = b'{}'
+
+
+@pytest.fixture
+def refreshes(monkeypatch):
+    redis_db.flushdb()
+    refreshes = []
+
+    def refresh(credentials, request):
+        refreshes.append(credentials.refresh_token)
+        credentials.token = 'new'
+        credentials.expiry = None
+
+    monkeypatch.setattr(google.oauth2.credentials.Credentials, 'refresh', refresh)
+    return refreshes
+
+
+@pytest.fixture
+def requests(monkeypatch):
+    requests = []
+
+    def request(method, uri, data=None, headers=None, timeout=None):
+        requests.append(headers)
+        return Response()
+
+    monkeypatch.setattr(transport.session, 'request', request)
+    return requests
+
+
+def test_expired_stored_token_is_refreshed_once_and_saved(refreshes, requests):
+    # Токен пользователя, выгруженного из памяти, истек в Redis
+    redis_db.set('1_token', json.dumps({'token': 'old', 'refresh_token': 'refresh', 'client_id': 'id',
+                                        'client_secret': 'secret', 'expiry': '2000-01-01T00:00:00Z'}))
+    refresher = user_data.TokenRefresher()
+    http = refresher.get_http(1)
+    expired = http.credentials
+    http.request('https://www.googleapis.com/calendar/v3/users/me/calendarList')
+
+    assert requests == [{'authorization': 'Bearer new'}]
+    assert refreshes == ['refresh']
+    assert json.loads(redis_db.get('1_token'))['token'] == 'new'
+    # Фоновое обновление, запланированное при загрузке, не обновляет токен повторно
+    http.refresh(expired)
+    assert refreshes == ['refresh']
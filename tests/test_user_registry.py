@@ -0,0 +1,70 @@
+import gc
+import weakref
+
+import pytest
+
+pytest.importorskip('dateutil')
+pytest.importorskip('googleapiclient')
+pytest.importorskip('fakeredis')
+
+from fakes import install_redis, setup_environment
+
+setup_environment()
+install_redis()
+
+import states
+import user_registry
+from user_data import redis_db
+
+
+@pytest.fixture
+def registry():
+    redis_db.flushdb()
+    return user_registry.UserRegistry()
+
+
+def test_borrow_shares_instance_with_get(registry):
+    with registry.borrow(1) as user:
+        assert registry.get(1) is user
+        with registry.borrow(1) as nested:
+            assert nested is user
+    # Пользователь, запрошенный через get, остается в кэше
+    assert registry.peek(1) is user
+
+
+def test_borrowed_user_is_saved_and_keeps_events(registry):
+    with registry.borrow(1) as user:
+        assert registry.peek(1) is user
+        user.state = states.TASKS_STATE
+        events = user.events
+    assert registry.peek(1) is None
+    assert redis_db.hget(user._fields_key, 'state') == str(states.TASKS_STATE).encode()
+    # Новый объект пользователя продолжает синхронизацию с сохраненными событиями
+    reloaded = registry.get(1)
+    assert reloaded is not user
+    assert reloaded.events is events
+    assert reloaded.state == states.TASKS_STATE
+
+
+def test_borrow_resident_user(registry):
+    user = registry.get(1)
+    with registry.borrow(1) as borrowed:
+        assert borrowed is user
+    assert registry.peek(1) is user
+
+
+def test_evicted_user_is_garbage_collected(registry, monkeypatch):
+    monkeypatch.setattr(user_registry, 'USER_CACHE_SIZE', 1)
+    monkeypatch.setattr(user_registry, 'USER_MIN_IDLE', 0)
+    with registry.borrow(1) as user:
+        borrowed = weakref.ref(user)
+    resident = weakref.ref(registry.get(2))
+    # Пользователь 2 вытесняется пользователем 3
+    registry.get(3)
+    del user
+    gc.collect()
+    # Сохраненные события не удерживают выгруженных пользователей
+    assert borrowed() is None
+    assert resident() is None
+    reloaded = registry.get(2)
+    assert reloaded.events._user is reloaded
@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+pytest.importorskip('googleapiclient')
+pytest.importorskip('fakeredis')
+
+from fakes import install_redis, setup_environment
+
+setup_environment()
+install_redis()
+
+import watch
+from user_data import redis_db
+from webhook import telegram_route
+
+
+def test_telegram_route_rejects_wrong_secret_token():
+    updates = []
+    handler = telegram_route('secret', lambda update: updates.append(update) or True)
+    assert handler({}, b'{}') == 403
+    assert handler({'X-Telegram-Bot-Api-Secret-Token': 'wrong'}, b'{}') == 403
+    assert updates == []
+    assert handler({'X-Telegram-Bot-Api-Secret-Token': 'secret'}, b'not json') == 400
+    assert handler({'X-Telegram-Bot-Api-Secret-Token': 'secret'}, json.dumps({'update_id': 1}).encode()) == 200
+    assert updates == [{'update_id': 1}]
+
+
+def test_telegram_route_reports_full_queue():
+    handler = telegram_route('secret', lambda update: False)
+    # Telegram повторит обновление, которое не поместилось в очередь
+    assert handler({'X-Telegram-Bot-Api-Secret-Token': 'secret'}, b'{}') == 503
+
+
+def test_routes_require_token():
+    with pytest.raises(ValueError):
+        telegram_route('', lambda update: True)
+    with pytest.raises(ValueError):
+        watch.watch_route('', lambda user_id: None)
+
+
+def test_watch_route_rejects_wrong_channel_token():
+    redis_db.flushdb()
+    redis_db.hset(watch.get_channel_key('channel'), 'user_id', 1)
+    changes = []
+    handler = watch.watch_route('token', changes.append)
+    headers = {'X-Goog-Channel-ID': 'channel', 'X-Goog-Resource-State': 'exists'}
+    assert handler(headers, b'') == 403
+    assert handler(dict(headers, **{'X-Goog-Channel-Token': 'wrong'}), b'') == 403
+    assert changes == []
+    assert handler(dict(headers, **{'X-Goog-Channel-Token': 'token'}), b'') == 200
+    assert changes == [1]
+    # Уведомления о создании канала и неизвестных каналах не вызывают обновления
+    assert handler(dict(headers, **{'X-Goog-Channel-Token': 'token', 'X-Goog-Resource-State': 'sync'}), b'') == 200
+    assert handler({'X-Goog-Channel-Token': 'token', 'X-Goog-Channel-ID': 'unknown'}, b'') == 200
+    assert changes == [1]
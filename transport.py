@@ -0,0 +1,78 @@
+from threading import Lock
+import os
+
+import httplib2
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# Размер пула keep-alive соединений, общего для всех пользователей
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 32))
+HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', 30))
+
+session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+session.mount('https://', _adapter)
+session.mount('http://', _adapter)
+
+_auth_request = None
+
+
+def get_auth_request():
+    # google.auth загружается при первом запросе к Google, а не при запуске бота
+    global _auth_request
+    if _auth_request is None:
+        from google.auth.transport.requests import Request
+        _auth_request = Request(session)
+    return _auth_request
+
+
+class AuthorizedHttp:
+    # httplib2-совместимый транспорт для googleapiclient поверх общего пула соединений requests.
+    # В отличие от httplib2.Http, может использоваться из нескольких потоков одновременно.
+    def __init__(self, credentials, refresh):
+        self.credentials = credentials
+        self._refresh_lock = Lock()
+        # refresh(http) обновляет токен, сохраняет его и отмечает отозванный доступ
+        self._refresh = refresh
+        self._unauthorized_lock = Lock()
+        # Пользователь отозвал доступ, запросы с этими учетными данными невозможны
+        self.revoked = False
+
+    def replace_credentials(self, credentials):
+        # Учетные данные, обновленные в фоне, заменяют текущие без ожидания запросов
+        with self._refresh_lock:
+            self.credentials = credentials
+
+    def refresh(self, credentials):
+        # Одно обновление на токен: фоновое обновление и запросы, получившие тот же устаревший токен,
+        # ждут одного обновления и используют его результат
+        with self._unauthorized_lock:
+            if self.credentials is credentials and not self.revoked:
+                self._refresh(self)
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        with self._refresh_lock:
+            credentials = self.credentials
+        if not credentials.valid:
+            # Токен истек, например, у пользователя, загруженного после выгрузки. credentials.before_request
+            # обновил бы его на месте без сохранения в Redis, поэтому обновление выполняет TokenRefresher.
+            self.refresh(credentials)
+            with self._refresh_lock:
+                credentials = self.credentials
+        request_headers = dict(headers or {})
+        credentials.apply(request_headers)
+        response = session.request(method, uri, data=body, headers=request_headers, timeout=HTTP_TIMEOUT)
+
+        if response.status_code == 401:
+            # Токен отозван или истек раньше срока - обновляем и повторяем запрос
+            self.refresh(credentials)
+            if not self.revoked:
+                request_headers = dict(headers or {})
+                with self._refresh_lock:
+                    self.credentials.apply(request_headers)
+                response = session.request(method, uri, data=body, headers=request_headers, timeout=HTTP_TIMEOUT)
+
+        info = dict(response.headers)
+        info['status'] = response.status_code
+        return httplib2.Response(info), response.content
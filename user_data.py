@@ -1,59 +1,392 @@
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+import functools
 from dateutil.tz import gettz
+import heapq
+import logging
 import os
-from threading import Lock
+from threading import Lock, Thread, Condition
 import json
+import time
 
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from google_auth_oauthlib.flow import Flow
-from google.auth.transport.requests import Request
-from oauthlib.oauth2.rfc6749.errors import InvalidGrantError
-import google.oauth2.credentials
 
 import redis
 
+import governor
+import metrics
 import states
 import taskutils
+import transport
+from event_store import EventStore
+
+
+logger = logging.getLogger(__name__)
+
+
+class InstrumentedRedis(redis.Redis):
+    # Считает обращения к Redis текущего потока, pipeline - одно обращение
+    def execute_command(self, *args, **options):
+        metrics.count_redis_round_trip()
+        return redis.Redis.execute_command(self, *args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error=True):
+        if self.command_stack:
+            metrics.count_redis_round_trip()
+        return redis.client.Pipeline.execute(self, raise_on_error)
 
 
 # Redis
 REDIS_URL = os.environ['REDIS_URL']
-redis_db = redis.from_url(REDIS_URL)
+redis_db = InstrumentedRedis.from_url(REDIS_URL)
+# Множество id авторизованных пользователей
+USERS_KEY = 'users'
+# Задержка отложенной записи состояния пользователей (сек), 0 - запись после каждого обновления
+REDIS_WRITE_BEHIND = float(os.environ.get('REDIS_WRITE_BEHIND', 0))
 
 
 # Служба авторизации в google
 SCOPES = ['https://www.googleapis.com/auth/calendar']
 GOOGLE_TOKEN = os.environ['GOOGLE_TOKEN']
 GOOGLE_CLIENT_CONFIG = json.loads(GOOGLE_TOKEN)
-flow = Flow.from_client_config(GOOGLE_CLIENT_CONFIG,
-                               SCOPES,
-                               redirect_uri='urn:ietf:wg:oauth:2.0:oob')
-AUTHORIZATION_URL, _ = flow.authorization_url(prompt='consent')
+# Документ описания Calendar API поставляется с ботом (из google-api-python-client 2.100.0), поэтому
+# создание сервиса не обращается к сети. Актуальная копия загружается из Google в фоне и хранится в Redis.
+DISCOVERY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'discovery_calendar_v3.json')
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/calendar/v3/rest'
+DISCOVERY_KEY = 'discovery_calendar_v3'
+DISCOVERY_TTL = int(os.environ.get('DISCOVERY_TTL', 24 * 60 * 60))
+
+# Время жизни кэша списка календарей (сек)
+CALENDARS_TTL = int(os.environ.get('CALENDARS_TTL', 300))
+# Токен обновляется заранее, за столько секунд до окончания
+TOKEN_REFRESH_MARGIN = int(os.environ.get('TOKEN_REFRESH_MARGIN', 5 * 60))
+TOKEN_REFRESH_CONCURRENCY = int(os.environ.get('TOKEN_REFRESH_CONCURRENCY', 4))
+# Множество id пользователей, отозвавших доступ к календарю
+REVOKED_USERS_KEY = 'revoked_users'
+
+# Время хранения индекса событие -> календарь в Redis (сек)
+EVENT_INDEX_TTL = int(os.environ.get('EVENT_INDEX_TTL', 24 * 60 * 60))
+
+
+def create_flow():
+    # Библиотеки OAuth загружаются при первой авторизации, а не при запуске бота
+    from google_auth_oauthlib.flow import Flow
+    return Flow.from_client_config(GOOGLE_CLIENT_CONFIG,
+                                   SCOPES,
+                                   redirect_uri='urn:ietf:wg:oauth:2.0:oob')
+
+
+@functools.lru_cache(maxsize=None)
+def get_authorization_url():
+    authorization_url, _ = create_flow().authorization_url(prompt='consent')
+    return authorization_url
+
+
+def get_authorized_user_ids():
+    user_ids = redis_db.smembers(USERS_KEY)
+    if not user_ids:
+        # Заполнение индекса по токенам, сохраненным до его появления
+        for key in redis_db.scan_iter(match='*_token'):
+            user_ids.add(key[:-len(b'_token')])
+        if user_ids:
+            redis_db.sadd(USERS_KEY, *user_ids)
+    return [int(user_id) for user_id in user_ids]
+
+
+class WriteBehind(Thread):
+    def __init__(self, delay):
+        Thread.__init__(self, daemon=True)
+        self._delay = delay
+        self._condition = Condition()
+        self._users = {}
+
+    def add(self, user):
+        with self._condition:
+            self._users[user.user_id] = user
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._users:
+                    self._condition.wait()
+            time.sleep(self._delay)
+            with self._condition:
+                users, self._users = self._users, {}
+            pipe = redis_db.pipeline(transaction=False)
+            saved = []
+            try:
+                for user in users.values():
+                    saved.append((user, user.save(pipe)))
+                pipe.execute()
+            except Exception:
+                logger.exception('Failed to write %s users', len(users))
+                # Поля возвращаются в список измененных и записываются при следующей попытке
+                for user, written in saved:
+                    user.restore_dirty(written)
+                with self._condition:
+                    for user in users.values():
+                        self._users.setdefault(user.user_id, user)
+
+
+write_behind = None
+if REDIS_WRITE_BEHIND > 0:
+    write_behind = WriteBehind(REDIS_WRITE_BEHIND)
+    write_behind.start()
+
+
+class TokenRefresher(Thread):
+    # Учетные данные пользователя общие для всех его объектов UserData и обновляются в фоне до окончания токена,
+    # поэтому запросы пользователей и напоминаний не ждут обновления токена
+    RETRY_INTERVAL = 60
+
+    def __init__(self):
+        Thread.__init__(self, daemon=True)
+        self._condition = Condition()
+        # user_id -> AuthorizedHttp
+        self._https = {}
+        # (время обновления, user_id)
+        self._queue = []
+        self._due = {}
+        self._executor = ThreadPoolExecutor(max_workers=TOKEN_REFRESH_CONCURRENCY)
+
+    def get_http(self, user_id):
+        with self._condition:
+            http = self._https.get(user_id)
+        if http is not None:
+            return http
+        redis_token = redis_db.get(f'{user_id}_token')
+        if not redis_token or redis_db.sismember(REVOKED_USERS_KEY, user_id):
+            return None
+        import google.oauth2.credentials
+        credentials = google.oauth2.credentials.Credentials.from_authorized_user_info(json.loads(redis_token))
+        with self._condition:
+            http = self._https.get(user_id)
+            if http is None:
+                http = self._https[user_id] = transport.AuthorizedHttp(credentials, self._refresh_now(user_id))
+                self._schedule(user_id, credentials)
+        return http
+
+    def add(self, user_id, credentials):
+        # Новые учетные данные после авторизации
+        redis_db.set(f'{user_id}_token', credentials.to_json())
+        redis_db.srem(REVOKED_USERS_KEY, user_id)
+        http = transport.AuthorizedHttp(credentials, self._refresh_now(user_id))
+        with self._condition:
+            self._https[user_id] = http
+            self._schedule(user_id, credentials)
+        return http
+
+    def remove(self, user_id):
+        # Пользователь выгружен из памяти: токен больше не обновляется в фоне, при загрузке читается из Redis
+        with self._condition:
+            self._https.pop(user_id, None)
+            self._due.pop(user_id, None)
+
+    def _refresh_now(self, user_id):
+        # Обновление токена при ответе 401 или истекшем токене, с сохранением в Redis и отметкой отзыва доступа
+        return functools.partial(self._refresh, user_id)
+
+    def _schedule(self, user_id, credentials, ts=None):
+        if ts is None:
+            # Время окончания неизвестно - токен обновляется сразу
+            expiry = credentials.expiry.replace(tzinfo=datetime.timezone.utc).timestamp() if credentials.expiry else 0
+            ts = expiry - TOKEN_REFRESH_MARGIN
+        self._due[user_id] = ts
+        heapq.heappush(self._queue, (ts, user_id))
+        self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while True:
+                    now = time.time()
+                    if self._queue and self._queue[0][0] <= now:
+                        ts, user_id = heapq.heappop(self._queue)
+                        if self._due.get(user_id) == ts:
+                            del self._due[user_id]
+                            break
+                        continue
+                    self._condition.wait(self._queue[0][0] - now if self._queue else None)
+                http = self._https.get(user_id)
+            if http is not None:
+                self._executor.submit(http.refresh, http.credentials)
+
+    def _refresh(self, user_id, http):
+        from google.auth.exceptions import RefreshError
+        import google.oauth2.credentials
+        old = http.credentials
+        # Обновляется копия: запросы продолжают использовать действующий токен
+        credentials = google.oauth2.credentials.Credentials(None,
+                                                            refresh_token=old.refresh_token,
+                                                            token_uri=old.token_uri,
+                                                            client_id=old.client_id,
+                                                            client_secret=old.client_secret,
+                                                            scopes=old.scopes)
+        try:
+            credentials.refresh(transport.get_auth_request())
+        except RefreshError as e:
+            if 'invalid_grant' in str(e):
+                self._revoke(user_id, http)
+                return
+            logger.exception('Failed to refresh token of user %s', user_id)
+            self._retry(user_id, http)
+            return
+        except Exception:
+            logger.exception('Failed to refresh token of user %s', user_id)
+            self._retry(user_id, http)
+            return
+
+        with self._condition:
+            if self._https.get(user_id, http) is not http:
+                # Пользователь авторизовался заново
+                return
+            http.replace_credentials(credentials)
+            if self._https.get(user_id) is http:
+                self._schedule(user_id, credentials)
+        try:
+            redis_db.set(f'{user_id}_token', credentials.to_json())
+        except Exception:
+            logger.exception('Failed to save token of user %s', user_id)
+
+    def _retry(self, user_id, http):
+        with self._condition:
+            if self._https.get(user_id) is http:
+                self._schedule(user_id, None, time.time() + self.RETRY_INTERVAL)
+
+    def _revoke(self, user_id, http):
+        # Напоминания и фоновая синхронизация пропускают пользователя до повторной авторизации
+        logger.info('Access of user %s has been revoked', user_id)
+        with self._condition:
+            if self._https.get(user_id, http) is not http:
+                return
+            http.revoked = True
+            self._https.pop(user_id, None)
+        pipe = redis_db.pipeline(transaction=False)
+        pipe.sadd(REVOKED_USERS_KEY, user_id)
+        pipe.srem(USERS_KEY, user_id)
+        pipe.execute()
+
+
+token_refresher = TokenRefresher()
+
+
+_discovery_lock = Lock()
+_discovery_document = None
+
+
+def _load_discovery_document():
+    try:
+        content = redis_db.get(DISCOVERY_KEY)
+    except Exception:
+        logger.exception('Failed to read discovery document')
+        content = None
+    if content is None:
+        with open(DISCOVERY_FILE, 'rb') as f:
+            content = f.read()
+        # Копия из Google используется со следующего запуска
+        Thread(target=_refresh_discovery_document, daemon=True).start()
+    return json.loads(content)
+
+
+def _refresh_discovery_document():
+    try:
+        response = transport.session.get(DISCOVERY_URL, timeout=transport.HTTP_TIMEOUT)
+        response.raise_for_status()
+        json.loads(response.content)
+        redis_db.set(DISCOVERY_KEY, response.content, ex=DISCOVERY_TTL)
+    except Exception:
+        logger.exception('Failed to refresh discovery document')
+
+
+def _create_resources(service, description):
+    # googleapiclient дополняет описание методов при первом создании ресурса;
+    # после создания всех ресурсов общий документ только читается
+    from googleapiclient.discovery import fix_method_name
+    for name, resource in description.get('resources', {}).items():
+        _create_resources(getattr(service, fix_method_name(name))(), resource)
+
+
+def build_service(http):
+    # Документ описания разбирается один раз на процесс и используется всеми пользователями
+    from googleapiclient.discovery import build_from_document
+    global _discovery_document
+    with _discovery_lock:
+        if _discovery_document is None:
+            document = _load_discovery_document()
+            service = build_from_document(document, http=http)
+            _create_resources(service, document)
+            _discovery_document = document
+            return service
+    return build_from_document(_discovery_document, http=http)
+
+
+def _is_duplicate(exception):
+    # Событие с этим id уже создано предыдущей попыткой вставки, ответ на которую не был получен
+    return isinstance(exception, HttpError) and exception.resp.status == 409
 
 
 class UserData:
-    def __init__(self, user_id):
-        redis_data = redis_db.get(f'{user_id}_data')
-        redis_dict = {}
-        if redis_data is not None:
-            redis_dict = json.loads(redis_data)
-        
+    # Поле хэша Redis -> атрибут
+    FIELDS = {
+        'state': '_state',
+        'task': '_current_task_name',
+        'calendar': '_calendar_id',
+        'tz_name': '_tz_name'
+    }
+
+    def __init__(self, user_id, events=None):
         self.user_id = user_id
-        self._state = redis_dict.get('state', states.MAIN_STATE)
-        self.service = None
+        self._dirty = set()
+        self._dirty_lock = Lock()
+        self._legacy_key = False
+
+        fields = {key.decode(): value.decode() for key, value in redis_db.hgetall(self._fields_key).items()}
+        if not fields:
+            # Перенос состояния из прежнего формата (JSON-строка)
+            redis_data = redis_db.get(f'{user_id}_data')
+            if redis_data is not None:
+                fields = json.loads(redis_data)
+                self._legacy_key = True
+                self._dirty.update(field for field in fields if field in self.FIELDS)
+
+        self._state = int(fields.get('state', states.MAIN_STATE))
+        self._service = None
+        self._http = None
+        # Защищает поиск и создание календаря бота
         self._lock = Lock()
-        self._current_task_name = redis_dict.get('task', '')
-        self._calendar_id = redis_dict.get('calendar', '')
-        self._tz_name = redis_dict.get('tz_name', 'UTC')
+        self._current_task_name = fields.get('task', '')
+        self._calendar_id = fields.get('calendar', '')
+        self._tz_name = fields.get('tz_name', 'UTC')
+        # События, сохраненные при выгрузке пользователя, переходят к новому объекту
+        self.events = events.attach(self) if events is not None else EventStore(self)
+        self._quota = governor.user_bucket()
+        self._calendars_lock = Lock()
+        self._calendars = None
+        self._calendars_etag = None
+        self._calendars_time = 0
 
-        redis_token = redis_db.get(f'{user_id}_token')
-        if redis_token:
-            credentials = google.oauth2.credentials.Credentials.from_authorized_user_info(json.loads(redis_token))
-            credentials.refresh(Request())
-            if credentials.valid:
-                self.service = build('calendar', 'v3', credentials=credentials)
-                self.tz_name = self._get_primary_calendar_tz_name()
+        # Токен обновляется в фоне, зона пользователя - при получении списка календарей
+        self._http = token_refresher.get_http(user_id)
+        if self._http is not None:
+            self.service = build_service(self._http)
+        self.save()
+
+    @property
+    def service(self):
+        # Пользователь, отозвавший доступ, считается неавторизованным
+        if self._http is not None and self._http.revoked:
+            return None
+        return self._service
+
+    @service.setter
+    def service(self, value):
+        self._service = value
 
     @property
     def state(self):
@@ -62,7 +395,7 @@ class UserData:
     @state.setter
     def state(self, value):
         self._state = value
-        self.dumps_to_redis()
+        self._mark_dirty('state')
 
     @property
     def current_task_name(self):
@@ -71,7 +404,7 @@ class UserData:
     @current_task_name.setter
     def current_task_name(self, value):
         self._current_task_name = value
-        self.dumps_to_redis()
+        self._mark_dirty('task')
 
     @property
     def tz_name(self):
@@ -80,122 +413,300 @@ class UserData:
     @tz_name.setter
     def tz_name(self, value):
         self._tz_name = value
-        self.dumps_to_redis()
+        self._mark_dirty('tz_name')
+        # Начало событий на весь день зависит от зоны пользователя
+        self.events.invalidate()
 
     def init_service(self, authorization_code):
+        from oauthlib.oauth2.rfc6749.errors import InvalidGrantError
+        # Flow хранит полученные учетные данные, поэтому для каждого кода создается свой
+        user_flow = create_flow()
         try:
-            flow.fetch_token(code=authorization_code)
+            user_flow.fetch_token(code=authorization_code)
         except InvalidGrantError:
             return False
 
-        credentials = flow.credentials
-        self.service = build('calendar', 'v3', credentials=credentials)
-        redis_db.set(f'{self.user_id}_token', credentials.to_json())
+        self._http = token_refresher.add(self.user_id, user_flow.credentials)
+        self.service = build_service(self._http)
+        self.invalidate_calendars()
+        self.events.reset()
+        redis_db.sadd(USERS_KEY, self.user_id)
         self.tz_name = self._get_primary_calendar_tz_name()
         return True
 
     def _get_primary_calendar_tz_name(self):
-        calendar = self.service.calendars().get(calendarId='primary').execute()
+        calendar = self.execute(self.service.calendars().get(calendarId='primary'))
         return calendar.get('timeZone', 'UTC')
 
     def _get_calendar_id(self):
-        self._lock.acquire()
-        try:
-            self.service.calendars().get(calendarId=self._calendar_id).execute()
-        except HttpError:
-            self._lock.release()
-            self._calendar_id = ''
-            for calendar in self.get_calendars():
+        with self._lock:
+            calendars = self.get_calendars()
+            if self._calendar_id and any(calendar['id'] == self._calendar_id for calendar in calendars):
+                return self._calendar_id
+
+            calendar_id = ''
+            for calendar in calendars:
                 if calendar['summary'] == 'kas_calendar_bot':
-                    self._calendar_id = calendar['id']
+                    calendar_id = calendar['id']
                     break
-            if not self._calendar_id:
-                calendar_dict = {
-                    'summary': 'kas_calendar_bot',
-                    'timeZone': self.tz_name
-                }
-                self._lock.acquire()
-                created_calendar = self.service.calendars().insert(body=calendar_dict).execute()
-                self._lock.release()
-                self._calendar_id = created_calendar['id']
-        else:
-            self._lock.release()
-        self.dumps_to_redis()
+            if not calendar_id:
+                # Календарь бота может быть скрыт или удален пользователем из списка
+                calendar_id = self._find_hidden_calendar()
+            if calendar_id:
+                self._calendar_id = calendar_id
+                self._mark_dirty('calendar')
+                return self._calendar_id
+
+            calendar_dict = {
+                'summary': 'kas_calendar_bot',
+                'timeZone': self.tz_name
+            }
+            created_calendar = self.execute(self.service.calendars().insert(body=calendar_dict))
+            self._calendar_id = created_calendar['id']
+            # Id записывается сразу: потерянный id привел бы к созданию еще одного календаря
+            redis_db.hset(self._fields_key, 'calendar', self._calendar_id)
+            self.invalidate_calendars()
+            return self._calendar_id
+
+    def _find_hidden_calendar(self):
+        for calendar in self._list_calendars(showHidden=True)[0]:
+            if calendar['id'] == self._calendar_id or calendar['summary'] == 'kas_calendar_bot':
+                return calendar['id']
+        if not self._calendar_id:
+            return ''
+        # Календарь удален из списка, но существует - возвращаем его в список
+        try:
+            self.execute(self.service.calendarList().insert(body={'id': self._calendar_id}))
+        except HttpError as e:
+            if e.resp.status == 404:
+                return ''
+            # 409 - календарь уже в списке
+            if e.resp.status != 409:
+                raise
+        self.invalidate_calendars()
         return self._calendar_id
 
     def add_task(self, task_name, dt):
+        start = dt.replace(tzinfo=gettz(self.tz_name))
+        event = taskutils.make_event(task_name, start, start + taskutils.TASK_DURATION, self.tz_name)
         calendar_id = self._get_calendar_id()
-        event = {
-            'summary': task_name,
-            'start': {
-                'dateTime': dt.replace(tzinfo=gettz(self.tz_name)).isoformat()
-            },
-            'end': {
-                'dateTime': (dt.replace(tzinfo=gettz(self.tz_name)) + datetime.timedelta(hours=1)).isoformat()
-            }
-        }
-        self._lock.acquire()
-        self.service.events().insert(calendarId=calendar_id, body=event).execute()
-        self._lock.release()
+        try:
+            self._insert_event(calendar_id, event)
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            # Календарь бота удален, кэш устарел
+            self.invalidate_calendars()
+            calendar_id = self._get_calendar_id()
+            self._insert_event(calendar_id, event)
+        self.events.invalidate()
+
+    def _insert_event(self, calendar_id, event):
+        try:
+            self.execute(self.service.events().insert(calendarId=calendar_id, body=event))
+        except HttpError as e:
+            if not _is_duplicate(e):
+                raise
+
+    def add_tasks(self, events):
+        # Вставка событий batch-запросами, для каждого события - исключение или None
+        calendar_id = self._get_calendar_id()
+        results = [None] * len(events)
+        pending = list(range(len(events)))
+        attempt = 0
+        while pending:
+            retry = []
+            for offset in range(0, len(pending), EventStore.BATCH_SIZE):
+                indexes = pending[offset:offset + EventStore.BATCH_SIZE]
+                exceptions = {}
+
+                def callback(request_id, response, exception):
+                    exceptions[int(request_id)] = exception
+
+                batch = self.service.new_batch_http_request(callback=callback)
+                for index in indexes:
+                    batch.add(self.service.events().insert(calendarId=calendar_id, body=events[index]),
+                              request_id=str(index))
+                self.execute(batch, tokens=len(indexes))
+                for index in indexes:
+                    exception = exceptions.get(index)
+                    results[index] = exception if not _is_duplicate(exception) else None
+                    if governor.is_retryable(results[index]) and attempt < governor.GOOGLE_MAX_RETRIES:
+                        retry.append(index)
+            pending = retry
+            if pending:
+                time.sleep(governor.backoff(attempt))
+                attempt += 1
+        self.events.invalidate()
+        return results
 
     def remove_task(self, task_id):
+        calendar_id = self._get_task_calendar_id(task_id)
+        if calendar_id is not None:
+            try:
+                self.execute(self.service.events().delete(calendarId=calendar_id, eventId=task_id))
+            except HttpError as e:
+                if e.resp.status == 404:
+                    # Индекс устарел - задача перенесена в другой календарь
+                    calendar_id = None
+                elif e.resp.status != 410:
+                    raise
+        if calendar_id is None:
+            self._remove_task_from_any_calendar(task_id)
+        self.events.invalidate()
+
+    def _remove_task_from_any_calendar(self, task_id):
         for calendar in self.get_calendars():
-            self._lock.acquire()
             try:
-                self.service.events().get(calendarId=calendar['id'], eventId=task_id).execute()
-            except HttpError:
-                continue
-            finally:
-                self._lock.release()
-            self._lock.acquire()
-            self.service.events().delete(calendarId=calendar['id'], eventId=task_id).execute()
-            self._lock.release()
+                self.execute(self.service.events().get(calendarId=calendar['id'], eventId=task_id))
+            except HttpError as e:
+                # Задачи нет в этом календаре, остальные ошибки не означают ее отсутствие
+                if e.resp.status in (404, 410):
+                    continue
+                raise
+            try:
+                self.execute(self.service.events().delete(calendarId=calendar['id'], eventId=task_id))
+            except HttpError as e:
+                if e.resp.status != 410:
+                    raise
+            return
+
+    def _get_task_calendar_id(self, task_id):
+        calendar_id = self.events.get_calendar_id(task_id)
+        if calendar_id is None:
+            calendar_id = redis_db.hget(self._event_index_key, task_id)
+            calendar_id = calendar_id.decode() if calendar_id is not None else None
+        return calendar_id
+
+    def index_events(self, event_calendars):
+        # Индекс событие -> календарь хранится и в Redis: удаление из списка, показанного до перезапуска
+        added = {event_id: calendar_id for event_id, calendar_id in event_calendars.items() if calendar_id}
+        removed = [event_id for event_id, calendar_id in event_calendars.items() if not calendar_id]
+        pipe = redis_db.pipeline(transaction=False)
+        if added:
+            pipe.hset(self._event_index_key, mapping=added)
+        if removed:
+            pipe.hdel(self._event_index_key, *removed)
+        pipe.expire(self._event_index_key, EVENT_INDEX_TTL)
+        pipe.execute()
+
+    def execute(self, request, tokens=1):
+        return governor.execute(request, self._quota, tokens)
+
+    def release_events(self):
+        # Хранилище событий переходит к следующему объекту пользователя и не ссылается на этот объект,
+        # иначе вместе с хранилищем в памяти остается service. Этот объект получает пустое хранилище.
+        events, self.events = self.events, EventStore(self)
+        return events.detach()
+
+    def invalidate_calendars(self):
+        with self._calendars_lock:
+            self._calendars = None
+            self._calendars_etag = None
+            self._calendars_time = 0
 
     def get_calendars(self):
-        self._lock.acquire()
-        calendars = self.service.calendarList().list().execute()
-        self._lock.release()
-        return calendars.get('items', [])
+        # Список календарей кэшируется на CALENDARS_TTL, затем перепроверяется по ETag
+        with self._calendars_lock:
+            if self._calendars is not None and time.time() - self._calendars_time < CALENDARS_TTL:
+                return self._calendars
+
+            try:
+                calendars, etag = self._list_calendars(self._calendars_etag if self._calendars is not None else None)
+            except HttpError as e:
+                if e.resp.status != 304:
+                    raise
+            else:
+                self._calendars = calendars
+                self._calendars_etag = etag
+                for calendar in self._calendars:
+                    if calendar.get('primary') and calendar.get('timeZone', self._tz_name) != self._tz_name:
+                        self.tz_name = calendar['timeZone']
+            self._calendars_time = time.time()
+            return self._calendars
+
+    def _list_calendars(self, etag=None, **params):
+        # Все страницы списка календарей; ETag проверяется по первой странице
+        calendars = []
+        page_token = None
+        while True:
+            page_params = dict(params, pageToken=page_token) if page_token else params
+            request = self.service.calendarList().list(**page_params)
+            if etag and not page_token:
+                request.headers['If-None-Match'] = etag
+            response = self.execute(request)
+            calendars.extend(response.get('items', []))
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return calendars, response.get('etag', etag)
 
     def get_tasks(self, min_date_time, max_date_time):
-        day_tasks = []
-        for calendar in self.get_calendars():
-            self._lock.acquire()
-            tasks = self.service.events().list(calendarId=calendar['id'],
-                                               timeMin=min_date_time.isoformat(),
-                                               timeMax=max_date_time.isoformat(),
-                                               singleEvents=True,
-                                               orderBy='startTime').execute()
-            self._lock.release()
-            day_tasks.extend(tasks.get('items', []))
-        day_tasks.sort(key=lambda task: taskutils.get_task_start_time_utc(task))
-        return day_tasks
+        return self.events.get_range(min_date_time, max_date_time)
 
     def get_day_tasks(self, date):
-        dt_min = datetime.datetime(date.year, date.month, date.day, 0, 0, 0, tzinfo=gettz(self.tz_name))
-        dt_max = datetime.datetime(date.year, date.month, date.day, 23, 59, 59, tzinfo=gettz(self.tz_name))
-        return self.get_tasks(dt_min, dt_max)
+        return self.get_period_tasks(date, date + datetime.timedelta(days=1))
+
+    def get_period_tasks(self, min_date, max_date):
+        return list(self.iter_period_tasks(min_date, max_date))
+
+    def iter_period_tasks(self, min_date, max_date):
+        # Задачи с начала min_date до начала max_date в зоне пользователя
+        tz = gettz(self.tz_name)
+        dt_min = datetime.datetime(min_date.year, min_date.month, min_date.day, tzinfo=tz)
+        dt_max = datetime.datetime(max_date.year, max_date.month, max_date.day, tzinfo=tz)
+        return self.events.iter_range(dt_min, dt_max)
+
+    def prefetch_tasks(self):
+        self.events.prefetch()
 
     def get_future_tasks(self):
-        future_tasks = []
-        now = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
-        for calendar in self.get_calendars():
-            now_str = now.isoformat()
-            self._lock.acquire()
-            tasks = self.service.events().list(calendarId=calendar['id'],
-                                               timeMin=now_str,
-                                               maxResults=5,
-                                               singleEvents=True,
-                                               orderBy='startTime').execute()
-            self._lock.release()
-            future_tasks.extend(tasks.get('items', []))
-        return future_tasks
-
-    def dumps_to_redis(self):
-        d = {
-            'state': self.state,
-            'task': self.current_task_name,
-            'calendar': self._calendar_id,
-            'tz_name': self.tz_name
-        }
-        redis_db.set(f'{self.user_id}_data', json.dumps(d))
+        return self.events.get_future(5)
+
+    @property
+    def _fields_key(self):
+        return f'{self.user_id}_fields'
+
+    @property
+    def _event_index_key(self):
+        return f'{self.user_id}_event_calendars'
+
+    def _mark_dirty(self, field):
+        with self._dirty_lock:
+            self._dirty.add(field)
+
+    def flush(self):
+        if write_behind is not None:
+            write_behind.add(self)
+        else:
+            self.save()
+
+    def save(self, pipe=None):
+        # Возвращает записанные поля, чтобы при ошибке записи pipeline их можно было вернуть через restore_dirty
+        with self._dirty_lock:
+            if not self._dirty:
+                return None
+            fields = {field: getattr(self, self.FIELDS[field]) for field in self._dirty}
+            self._dirty.clear()
+            legacy_key, self._legacy_key = self._legacy_key, False
+
+        execute = pipe is None
+        if execute:
+            pipe = redis_db.pipeline(transaction=False)
+        pipe.hset(self._fields_key, mapping=fields)
+        if legacy_key:
+            pipe.delete(f'{self.user_id}_data')
+        if execute:
+            try:
+                pipe.execute()
+            except Exception:
+                self.restore_dirty((fields, legacy_key))
+                raise
+        return fields, legacy_key
+
+    def restore_dirty(self, written):
+        if written is None:
+            return
+        fields, legacy_key = written
+        with self._dirty_lock:
+            self._dirty.update(fields)
+            self._legacy_key = self._legacy_key or legacy_key
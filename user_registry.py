@@ -0,0 +1,225 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Lock, Thread
+import logging
+import os
+import time
+
+import governor
+from user_data import UserData, get_authorized_user_ids, token_refresher
+
+
+logger = logging.getLogger(__name__)
+
+# Максимальное количество одновременно загружаемых пользователей
+HYDRATION_CONCURRENCY = int(os.environ.get('HYDRATION_CONCURRENCY', 8))
+# Максимальное количество пользователей в памяти. Память пользователя занимает в основном
+# объект service Google, поэтому бюджет памяти задается количеством пользователей.
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 10000))
+# Время без обращений, после которого пользователь выгружается из памяти (сек)
+USER_IDLE_TIME = int(os.environ.get('USER_IDLE_TIME', 6 * 60 * 60))
+# Недавно использованный пользователь может обрабатывать обновление и не выгружается (сек)
+USER_MIN_IDLE = 60
+# Количество выгруженных пользователей, для которых в памяти остаются загруженные события и токены синхронизации.
+# Без них фоновое обновление выгруженного пользователя каждый раз загружает все события заново.
+EVICTED_EVENTS_CACHE_SIZE = int(os.environ.get('EVICTED_EVENTS_CACHE_SIZE', 1000))
+
+
+class UserRegistry:
+    def __init__(self):
+        self._lock = Lock()
+        # user_id -> UserData в порядке последнего обращения
+        self._users = OrderedDict()
+        self._used = {}
+        # Выгружаемые пользователи, состояние которых еще записывается в Redis
+        self._evicting = {}
+        # user_id -> (UserData, количество фоновых задач), пользователи вне кэша, используемые фоновыми задачами
+        self._borrowed = {}
+        # user_id -> EventStore выгруженных пользователей в порядке выгрузки
+        self._events = OrderedDict()
+        # Авторизованные пользователи, в том числе выгруженные
+        self._user_ids = set()
+        self._pending = {}
+        self._next_idle_check = 0
+        self._executor = ThreadPoolExecutor(max_workers=HYDRATION_CONCURRENCY)
+
+    def get(self, user_id):
+        while True:
+            with self._lock:
+                user = self._find(user_id)
+                if user is not None:
+                    self._touch(user_id, user)
+                    evicted = self._evict()
+                    break
+                future = self._pending.get(user_id)
+                owner = future is None
+                if owner:
+                    future = self._pending[user_id] = Future()
+            if owner:
+                self._load(user_id, future)
+                return future.result()
+            try:
+                return future.result()
+            except Exception:
+                # Фоновая загрузка не удалась - пробуем загрузить пользователя сами
+                continue
+        self._save(evicted)
+        return user
+
+    def peek(self, user_id):
+        with self._lock:
+            return self._find(user_id)
+
+    @contextmanager
+    def borrow(self, user_id):
+        # Пользователь для фоновых задач: выгруженный загружается из Redis без добавления в кэш.
+        # До окончания задачи get возвращает тот же объект, после нее пользователь сохраняется и выгружается.
+        user = self._borrow(user_id)
+        try:
+            yield user
+        finally:
+            self._release(user)
+
+    def _borrow(self, user_id):
+        while True:
+            with self._lock:
+                user = self._find(user_id)
+                if user is None:
+                    future = self._pending.get(user_id)
+                    owner = future is None
+                    if owner:
+                        future = self._pending[user_id] = Future()
+            if user is None:
+                if owner:
+                    self._load(user_id, future, cache=False)
+                try:
+                    user = future.result()
+                except Exception:
+                    if owner:
+                        raise
+                    continue
+            with self._lock:
+                if self._find(user_id) is not user:
+                    # Пользователь выгружен, пока задача ждала загрузки
+                    continue
+                _, count = self._borrowed.get(user_id, (user, 0))
+                self._borrowed[user_id] = (user, count + 1)
+            return user
+
+    def _release(self, user):
+        with self._lock:
+            _, count = self._borrowed[user.user_id]
+            if count > 1:
+                self._borrowed[user.user_id] = (user, count - 1)
+                return
+            del self._borrowed[user.user_id]
+            if self._users.get(user.user_id) is user or self._evicting.get(user.user_id) is user:
+                return
+            # Пока состояние записывается, пользователь остается доступен через _evicting
+            self._evicting[user.user_id] = user
+        self._save([user])
+
+    def user_ids(self):
+        with self._lock:
+            return list(self._user_ids.union(self._users))
+
+    def hydrate(self):
+        Thread(target=self._hydrate, daemon=True).start()
+
+    def _hydrate(self):
+        try:
+            user_ids = get_authorized_user_ids()
+        except Exception:
+            logger.exception('Failed to read authorized users')
+            return
+        with self._lock:
+            self._user_ids.update(user_ids)
+        # Остальные пользователи загружаются по запросу
+        for user_id in user_ids[:USER_CACHE_SIZE]:
+            with self._lock:
+                if user_id in self._users or user_id in self._pending:
+                    continue
+                future = self._pending[user_id] = Future()
+            self._executor.submit(self._load_in_background, user_id, future)
+
+    def _load_in_background(self, user_id, future):
+        with governor.background():
+            self._load(user_id, future)
+
+    def _load(self, user_id, future, cache=True):
+        with self._lock:
+            events = self._events.pop(user_id, None)
+        try:
+            user = UserData(user_id, events)
+        except Exception as e:
+            logger.exception('Failed to load user %s', user_id)
+            with self._lock:
+                del self._pending[user_id]
+            future.set_exception(e)
+            return
+        with self._lock:
+            if cache:
+                self._touch(user_id, user)
+            else:
+                # Счетчик задач увеличивается в _borrow
+                self._borrowed[user_id] = (user, 0)
+            if user.service:
+                self._user_ids.add(user_id)
+            del self._pending[user_id]
+            evicted = self._evict()
+        future.set_result(user)
+        self._save(evicted)
+
+    def _find(self, user_id):
+        user = self._users.get(user_id) or self._evicting.get(user_id)
+        if user is None and user_id in self._borrowed:
+            user = self._borrowed[user_id][0]
+        return user
+
+    def _touch(self, user_id, user):
+        self._users[user_id] = user
+        self._users.move_to_end(user_id)
+        self._used[user_id] = time.monotonic()
+
+    def _evict(self):
+        # Выгрузка самых давних пользователей сверх размера кэша и простаивающих дольше USER_IDLE_TIME
+        now = time.monotonic()
+        check_idle = now >= self._next_idle_check
+        if check_idle:
+            self._next_idle_check = now + USER_MIN_IDLE
+        evicted = []
+        while self._users:
+            user_id = next(iter(self._users))
+            idle = now - self._used[user_id]
+            if idle < USER_MIN_IDLE or (len(self._users) <= USER_CACHE_SIZE and
+                                        (not check_idle or idle < USER_IDLE_TIME)):
+                break
+            user = self._users.pop(user_id)
+            del self._used[user_id]
+            if user.service:
+                self._user_ids.add(user_id)
+            self._evicting[user_id] = user
+            evicted.append(user)
+        return evicted
+
+    def _save(self, users):
+        for user in users:
+            try:
+                user.save()
+            except Exception:
+                logger.exception('Failed to save evicted user %s', user.user_id)
+            with self._lock:
+                if self._evicting.get(user.user_id) is user:
+                    del self._evicting[user.user_id]
+                    if self._find(user.user_id) is None:
+                        self._keep_events(user)
+                        token_refresher.remove(user.user_id)
+
+    def _keep_events(self, user):
+        # События выгруженного пользователя остаются в памяти: при следующей загрузке
+        # синхронизация продолжается по syncToken, а не загружает все события заново
+        self._events[user.user_id] = user.release_events()
+        self._events.move_to_end(user.user_id)
+        while len(self._events) > EVICTED_EVENTS_CACHE_SIZE:
+            self._events.popitem(last=False)
@@ -0,0 +1,192 @@
+from threading import Thread
+import hmac
+import logging
+import os
+import time
+import uuid
+
+from googleapiclient.errors import HttpError
+
+import governor
+from user_data import redis_db
+
+
+logger = logging.getLogger(__name__)
+
+# Адрес, на который Google отправляет уведомления об изменениях календарей, пустой - каналы не используются
+WATCH_URL = os.environ.get('WATCH_URL', '')
+WATCH_PATH = os.environ.get('WATCH_PATH', '/calendar')
+WATCH_TOKEN = os.environ.get('WATCH_TOKEN', '')
+# Запрашиваемое время жизни канала и запас до его окончания, при котором канал продлевается (сек)
+WATCH_TTL = int(os.environ.get('WATCH_TTL', 7 * 24 * 60 * 60))
+WATCH_RENEW_BEFORE = 60 * 60
+
+# id канала -> время окончания
+CHANNELS_KEY = 'watch_channels'
+
+
+def get_channel_key(channel_id):
+    return f'channel_{channel_id}'
+
+
+def get_user_channels_key(user_id):
+    return f'{user_id}_channels'
+
+
+def get_channel_user_id(channel_id):
+    user_id = redis_db.hget(get_channel_key(channel_id), 'user_id')
+    return int(user_id) if user_id is not None else None
+
+
+def watch_route(token, on_change):
+    # Уведомление содержит только id канала: пользователь находится по каналу,
+    # его кэш событий и напоминания обновляются при следующем обращении
+    if not token:
+        raise ValueError('watch token is required')
+
+    def handler(headers, body):
+        if not hmac.compare_digest(headers.get('X-Goog-Channel-Token', '').encode(), token.encode()):
+            return 403
+        if headers.get('X-Goog-Resource-State') == 'sync':
+            # Первое уведомление после создания канала
+            return 200
+        user_id = get_channel_user_id(headers.get('X-Goog-Channel-ID', ''))
+        if user_id is not None:
+            on_change(user_id)
+        return 200
+    return handler
+
+
+class CalendarWatcher(Thread):
+    # Интервал проверки каналов (сек)
+    CHECK_INTERVAL = 60
+    # Интервал повторной проверки каналов пользователя, покрывает новые календари (сек)
+    USER_CHECK_INTERVAL = 60 * 60
+
+    def __init__(self, users, leases):
+        Thread.__init__(self, daemon=True)
+        self._users = users
+        self._leases = leases
+        # user_id -> время следующей проверки каналов
+        self._checks = {}
+
+    def run(self):
+        while True:
+            with governor.background():
+                try:
+                    self.renew_channels()
+                except Exception:
+                    logger.exception('Failed to renew watch channels')
+                try:
+                    self.check_users()
+                except Exception:
+                    logger.exception('Failed to check watch channels')
+            time.sleep(self.CHECK_INTERVAL)
+
+    def renew_channels(self):
+        now = time.time()
+        for channel_id in redis_db.zrangebyscore(CHANNELS_KEY, 0, now + WATCH_RENEW_BEFORE):
+            channel_id = channel_id.decode()
+            channel = {key.decode(): value.decode() for key, value in
+                       redis_db.hgetall(get_channel_key(channel_id)).items()}
+            if not channel:
+                redis_db.zrem(CHANNELS_KEY, channel_id)
+                continue
+            user_id = int(channel['user_id'])
+            if not self._leases.owns(user_id):
+                continue
+            try:
+                with self._users.borrow(user_id) as user:
+                    self._renew_channel(user, channel_id, channel, now)
+            except Exception:
+                logger.exception('Failed to renew watch channel of user %s', user_id)
+
+    def _renew_channel(self, user, channel_id, channel, now):
+        if user.service:
+            try:
+                self._watch(user, channel['calendar_id'])
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                # Календарь удален - список календарей в кэше устарел
+                user.invalidate_calendars()
+            self._stop(user, channel_id, channel['resource_id'])
+        elif float(channel['expiration']) > now:
+            # Пользователь не авторизован, канал удаляется по окончании
+            return
+        self._forget(channel_id, channel)
+
+    def check_users(self):
+        now = time.time()
+        for user_id in self._users.user_ids():
+            if self._checks.get(user_id, 0) > now or not self._leases.owns(user_id):
+                continue
+            user = self._users.peek(user_id)
+            if user is None or not user.service:
+                continue
+            try:
+                self._check_user(user)
+            except Exception:
+                logger.exception('Failed to check watch channels of user %s', user_id)
+                self._checks[user_id] = now + self.CHECK_INTERVAL
+            else:
+                self._checks[user_id] = now + self.USER_CHECK_INTERVAL
+
+    def _check_user(self, user):
+        channels = {key.decode() for key in redis_db.hkeys(get_user_channels_key(user.user_id))}
+        created = False
+        for calendar in user.get_calendars():
+            if calendar['id'] not in channels:
+                self._watch(user, calendar['id'])
+                created = True
+        if created:
+            # Изменения, сделанные до открытия канала, забираются синхронизацией
+            user.events.invalidate()
+        user.events.watched = True
+
+    def _watch(self, user, calendar_id):
+        if not WATCH_TOKEN:
+            # Без токена уведомления канала может подделать любой, кто знает адрес
+            raise ValueError('WATCH_TOKEN is required to watch calendars')
+        channel_id = uuid.uuid4().hex
+        response = user.execute(user.service.events().watch(calendarId=calendar_id, body={
+            'id': channel_id,
+            'type': 'web_hook',
+            'address': WATCH_URL + WATCH_PATH,
+            'token': WATCH_TOKEN,
+            'params': {'ttl': str(WATCH_TTL)}
+        }))
+        expiration = int(response['expiration']) / 1000
+        pipe = redis_db.pipeline()
+        pipe.hset(get_channel_key(channel_id), mapping={
+            'user_id': user.user_id,
+            'calendar_id': calendar_id,
+            'resource_id': response['resourceId'],
+            'expiration': expiration
+        })
+        pipe.expireat(get_channel_key(channel_id), int(expiration) + 1)
+        pipe.zadd(CHANNELS_KEY, {channel_id: expiration})
+        pipe.hset(get_user_channels_key(user.user_id), calendar_id, channel_id)
+        pipe.execute()
+
+    def _stop(self, user, channel_id, resource_id):
+        try:
+            user.execute(user.service.channels().stop(body={'id': channel_id, 'resourceId': resource_id}))
+        except HttpError as e:
+            if e.resp.status != 404:
+                logger.exception('Failed to stop watch channel of user %s', user.user_id)
+
+    def _forget(self, channel_id, channel):
+        user_id = int(channel['user_id'])
+        key = get_user_channels_key(user_id)
+        if redis_db.hget(key, channel['calendar_id']) == channel_id.encode():
+            # Календарь остался без канала - до следующей проверки изменения видны только по интервалу
+            redis_db.hdel(key, channel['calendar_id'])
+            user = self._users.peek(user_id)
+            if user is not None:
+                user.events.watched = False
+            self._checks.pop(user_id, None)
+        pipe = redis_db.pipeline()
+        pipe.delete(get_channel_key(channel_id))
+        pipe.zrem(CHANNELS_KEY, channel_id)
+        pipe.execute()
@@ -0,0 +1,55 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+import hmac
+import json
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address):
+        ThreadingHTTPServer.__init__(self, address, WebhookRequestHandler)
+        # Путь -> обработчик(headers, body), возвращающий HTTP-статус
+        self.routes = {}
+
+    def add_route(self, path, handler):
+        self.routes[path] = handler
+
+    def start(self):
+        Thread(target=self.serve_forever, daemon=True).start()
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        handler = self.server.routes.get(self.path)
+        if handler is None:
+            self.send_error(404)
+            return
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        status = handler(self.headers, body)
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def telegram_route(secret_token, on_update):
+    # Обновление сразу ставится в очередь, ответ Telegram не ждет обработки.
+    # Если очередь переполнена, Telegram повторит запрос позже.
+    if not secret_token:
+        raise ValueError('secret token is required')
+
+    def handler(headers, body):
+        token = headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token.encode(), secret_token.encode()):
+            return 403
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return 400
+        return 200 if on_update(update) else 503
+    return handler